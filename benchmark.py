@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# end to end benchmark on synthetic data; generate images with known bug positions then time
+# materialise -> input pipeline -> train -> predict -> test, writing a json report that can be
+# compared against a previous (baseline) report to catch regressions in any stage.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from label_db import LabelDB
+from labels import Bug
+from timing import StageTimer
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['materialise', 'input_pipeline', 'train', 'predict', 'test']
+
+
+def generate_synthetic_data(image_dir, label_db_file, num_images, width, height, bugs_per_image,
+                            bug_radius=4, seed=123, relative_filenames=False):
+    # write num_images noisy background pngs, each with bugs_per_image dark ellipses at known
+    # positions, and record those positions as complete labels in label_db_file.
+    # filenames are stored as absolute paths (as label_ui.py does) unless relative_filenames,
+    # in which case they are relative to image_dir (as test.py looks them up)
+    rng = np.random.RandomState(seed)
+    os.makedirs(image_dir, exist_ok=True)
+    label_db = LabelDB(label_db_file=label_db_file)
+    label_db.create_if_required()
+    margin = 2 * bug_radius
+    for i in range(num_images):
+        background = rng.normal(170, 12, size=(height, width, 3)).clip(0, 255).astype(np.uint8)
+        img = Image.fromarray(background)
+        draw = ImageDraw.Draw(img)
+        bugs = []
+        for _ in range(bugs_per_image):
+            x = int(rng.randint(margin, width - margin))
+            y = int(rng.randint(margin, height - margin))
+            rx, ry = bug_radius, int(bug_radius * rng.uniform(0.5, 1.0))
+            draw.ellipse((x - rx, y - ry, x + rx, y + ry), fill=(70, 40, 30))
+            bugs.append(Bug(x, y, None))
+        filename = os.path.join(image_dir, "synthetic_%05d.png" % i)
+        img.save(filename)
+        db_filename = os.path.basename(filename) if relative_filenames else os.path.abspath(filename)
+        label_db.set_labels(db_filename, bugs)
+        label_db.set_complete(db_filename, True)
+
+
+def run_script(script, *args, verbose=False):
+    cmd = [sys.executable, os.path.join(SRC_DIR, script)] + [str(a) for a in args]
+    print(">", " ".join(cmd), file=sys.stderr)
+    subprocess.run(cmd, check=True, stdout=None if verbose else subprocess.DEVNULL)
+
+
+def environment():
+    env = {'python': platform.python_version(),
+           'platform': platform.platform(),
+           'processor': platform.processor(),
+           'cpu_count': os.cpu_count(),
+           'numpy': np.__version__}
+    try:
+        import tensorflow as tf
+        env['tensorflow'] = tf.__version__
+    except ImportError:
+        pass
+    return env
+
+
+def compare_to_baseline(report, baseline, threshold):
+    # print per stage time ratios vs baseline, return names of stages slower than threshold x
+    regressions = []
+    print("%-16s %10s %10s %7s" % ('stage', 'base_secs', 'secs', 'ratio'))
+    for stage, stats in report['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+        base_secs = baseline['stages'][stage]['secs']
+        ratio = stats['secs'] / base_secs if base_secs > 0 else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(stage)
+            flag = ' REGRESSION'
+        print("%-16s %10.2f %10.2f %7.2f%s" % (stage, base_secs, stats['secs'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--work-dir', type=str, default=None,
+                        help='where to write synthetic data, ckpts etc. '
+                             'if not set use a temp dir that is removed after')
+    parser.add_argument('--report', type=str, default='bench_report.json', help='where to write json report')
+    parser.add_argument('--baseline', type=str, default=None, help='if set, compare against this earlier report')
+    parser.add_argument('--regression-threshold', type=float, default=1.2,
+                        help='flag stages that take more than this times the --baseline time')
+    parser.add_argument('--stages', type=str, default=','.join(STAGES), help='comma separated stages to run')
+    parser.add_argument('--num-train-images', type=int, default=16, help=' ')
+    parser.add_argument('--num-test-images', type=int, default=4, help=' ')
+    parser.add_argument('--width', type=int, default=512, help='synthetic image width; multiple of 16')
+    parser.add_argument('--height', type=int, default=384, help='synthetic image height; multiple of 16')
+    parser.add_argument('--bugs-per-image', type=int, default=20, help=' ')
+    parser.add_argument('--bug-radius', type=int, default=4, help=' ')
+    parser.add_argument('--seed', type=int, default=123, help=' ')
+    parser.add_argument('--batch-size', type=int, default=4, help=' ')
+    parser.add_argument('--patch-width-height', type=int, default=128, help=' ')
+    parser.add_argument('--base-filter-size', type=int, default=8, help=' ')
+    parser.add_argument('--input-batches', type=int, default=20, help='number of batches to time input pipeline for')
+    parser.add_argument('--steps', type=int, default=20, help='train.py --steps; total optimizer steps')
+    parser.add_argument('--train-steps', type=int, default=10, help='train.py --train-steps')
+    parser.add_argument('--verbose', action='store_true', help='show output of stage scripts')
+    opts = parser.parse_args(argv)
+
+    stages = opts.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            raise Exception("unknown stage [%s]; expected one of %s" % (stage, STAGES))
+
+    report_file = os.path.abspath(opts.report)
+    baseline_file = os.path.abspath(opts.baseline) if opts.baseline is not None else None
+    work_dir = opts.work_dir or tempfile.mkdtemp(prefix='bnn_bench_')
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    # train / predict / test all read & write ckpts/<run> relative to cwd
+    os.chdir(work_dir)
+    run = 'bench'
+
+    train_image_dir = os.path.join(work_dir, 'synthetic/train')
+    test_image_dir = os.path.join(work_dir, 'synthetic/test')
+    label_db_file = os.path.join(work_dir, 'synthetic/labels.db')
+    test_label_db_file = os.path.join(work_dir, 'synthetic/test_labels.db')
+    materialised_image_dir = os.path.join(work_dir, 'materialised/images')
+    materialised_label_dir = os.path.join(work_dir, 'materialised/labels')
+
+    timer = StageTimer()
+    results = {}
+
+    with timer.stage('generate'):
+        generate_synthetic_data(train_image_dir, label_db_file, opts.num_train_images, opts.width, opts.height,
+                                opts.bugs_per_image, opts.bug_radius, seed=opts.seed)
+        generate_synthetic_data(test_image_dir, test_label_db_file, opts.num_test_images, opts.width, opts.height,
+                                opts.bugs_per_image, opts.bug_radius, seed=opts.seed + 1, relative_filenames=True)
+
+    if 'materialise' in stages:
+        with timer.stage('materialise'):
+            run_script('materialise_label_db.py',
+                       '--label-db', label_db_file,
+                       '--image-output-dir', materialised_image_dir,
+                       '--label-output-dir', materialised_label_dir,
+                       verbose=opts.verbose)
+        results['materialise'] = {'images_per_sec': opts.num_train_images / timer.times['materialise'][-1]}
+
+    if 'input_pipeline' in stages:
+        import generate_training_data
+        dataset = generate_training_data.img_xys_iterator(
+            image_dir=materialised_image_dir,
+            label_dir=materialised_label_dir,
+            batch_size=opts.batch_size,
+            patch_width_height=opts.patch_width_height,
+            distort_rgb=True,
+            flip_left_right=True,
+            random_rotation=False,
+            repeat=True
+        )
+        batches = iter(dataset)
+        next(batches)  # exclude pipeline construction & first fill from timing
+        with timer.stage('input_pipeline'):
+            for _ in range(opts.input_batches):
+                next(batches)
+        results['input_pipeline'] = {
+            'examples_per_sec': opts.input_batches * opts.batch_size / timer.times['input_pipeline'][-1]}
+
+    if 'train' in stages:
+        with timer.stage('train'):
+            run_script('train.py',
+                       '--run', run,
+                       '--train-image-dir', materialised_image_dir,
+                       '--test-image-dir', test_image_dir,
+                       '--label-dir', materialised_label_dir,
+                       '--label-db', test_label_db_file,
+                       '--batch-size', opts.batch_size,
+                       '--patch-width-height', opts.patch_width_height,
+                       '--base-filter-size', opts.base_filter_size,
+                       '--steps', opts.steps,
+                       '--train-steps', opts.train_steps,
+                       '--width', opts.width,
+                       '--height', opts.height,
+                       verbose=opts.verbose)
+        num_train_examples = opts.steps * opts.batch_size
+        results['train'] = {'examples_per_sec': num_train_examples / timer.times['train'][-1]}
+
+    if 'predict' in stages:
+        with timer.stage('predict'):
+            run_script('predict.py',
+                       '--run', run,
+                       '--image-dir', test_image_dir,
+                       '--output-label-db', os.path.join(work_dir, 'predictions.db'),
+                       verbose=opts.verbose)
+        results['predict'] = {'images_per_sec': opts.num_test_images / timer.times['predict'][-1]}
+
+    if 'test' in stages:
+        import test
+        with timer.stage('test'):
+            stats = test.pr_stats(run, test_image_dir, test_label_db_file, connected_components_threshold=0.05)
+        results['test'] = {k: stats[k] for k in ['precision', 'recall', 'f1']}
+
+    report = {
+        'created': datetime.datetime.now().isoformat(),
+        'opts': vars(opts),
+        'environment': environment(),
+        'stages': {}
+    }
+    for stage, stats in timer.stats().items():
+        report['stages'][stage] = {'secs': stats['total']}
+        report['stages'][stage].update(results.get(stage, {}))
+
+    with open(report_file, 'w') as f:
+        f.write(json.dumps(report, indent=2))
+    print("wrote report to [%s]" % report_file)
+    print(json.dumps(report['stages'], indent=2))
+
+    if opts.work_dir is None:
+        os.chdir(SRC_DIR)
+        shutil.rmtree(work_dir)
+
+    if baseline_file is not None:
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(report, baseline, opts.regression_threshold)
+        if regressions:
+            print("regressions in %s" % regressions, file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
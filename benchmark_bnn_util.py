@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+# microbenchmarks of the bnn_util bitmap / image conversion helpers against the original
+# per pixel / per point versions they replaced (kept here as reference implementations).
+# also checks both versions give the same result.
+
+import argparse
+import timeit
+
+import numpy as np
+from PIL import Image
+
+import bnn_util
+
+
+def reference_xys_to_bitmap(xys, height, width, rescale=1.0):
+    bitmap = np.zeros((int(height * rescale), int(width * rescale), 1), dtype=np.float32)
+    for x, y in xys:
+        bitmap[int(y * rescale), int(x * rescale), 0] = 1.0
+    return bitmap
+
+
+def reference_bitmap_to_pil_image(bitmap):
+    h, w, c = bitmap.shape
+    rgb_array = np.zeros((h, w, 3), dtype=np.uint8)
+    single_channel = bitmap[:, :, 0] * 255
+    rgb_array[:, :, 0] = single_channel
+    rgb_array[:, :, 1] = single_channel
+    rgb_array[:, :, 2] = single_channel
+    return Image.fromarray(rgb_array)
+
+
+def reference_zero_centered_array_to_pil_image(orig_array):
+    array = orig_array + 1
+    array *= 127.5
+    array = array.copy().astype(np.uint8)
+    assert np.min(array) >= 0
+    assert np.max(array) <= 255
+    return Image.fromarray(array)
+
+
+def bench(name, reference_fn, fn, number):
+    reference_secs = min(timeit.repeat(reference_fn, number=number, repeat=3)) / number
+    secs = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print("%-36s reference %9.3f ms  current %9.3f ms  speedup %6.1fx" % (
+        name, 1000 * reference_secs, 1000 * secs, reference_secs / secs))
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--width', type=int, default=5472, help='image width')
+parser.add_argument('--height', type=int, default=3648, help='image height')
+parser.add_argument('--num-points', type=int, default=1000, help='number of labels for xys_to_bitmap')
+parser.add_argument('--number', type=int, default=5, help='calls per timing')
+opts = parser.parse_args()
+
+rng = np.random.RandomState(123)
+xys = list(zip(rng.randint(0, opts.width, opts.num_points), rng.randint(0, opts.height, opts.num_points)))
+bitmap = rng.uniform(size=(opts.height // 2, opts.width // 2, 1)).astype(np.float32)
+rgb = rng.uniform(-1, 1, size=(opts.height, opts.width, 3)).astype(np.float32)
+
+# same outputs
+assert np.array_equal(reference_xys_to_bitmap(xys, opts.height, opts.width, rescale=0.5),
+                      bnn_util.xys_to_bitmap(xys, opts.height, opts.width, rescale=0.5))
+assert np.array_equal(np.array(reference_bitmap_to_pil_image(bitmap)),
+                      np.array(bnn_util.bitmap_to_pil_image(bitmap)))
+assert np.array_equal(np.array(reference_zero_centered_array_to_pil_image(rgb)),
+                      np.array(bnn_util.zero_centered_array_to_pil_image(rgb)))
+
+print("%dx%d image, %d labels" % (opts.width, opts.height, opts.num_points))
+bench('xys_to_bitmap',
+      lambda: reference_xys_to_bitmap(xys, opts.height, opts.width, rescale=0.5),
+      lambda: bnn_util.xys_to_bitmap(xys, opts.height, opts.width, rescale=0.5),
+      opts.number)
+bench('bitmap_to_pil_image',
+      lambda: reference_bitmap_to_pil_image(bitmap),
+      lambda: bnn_util.bitmap_to_pil_image(bitmap),
+      opts.number)
+bench('zero_centered_array_to_pil_image',
+      lambda: reference_zero_centered_array_to_pil_image(rgb),
+      lambda: bnn_util.zero_centered_array_to_pil_image(rgb),
+      opts.number)
+
+secs = min(timeit.repeat(lambda: bnn_util.xys_to_bitmap(xys, opts.height, opts.width, rescale=0.5, sigma=2.0),
+                         number=opts.number, repeat=3)) / opts.number
+print("%-36s current %9.3f ms" % ('xys_to_bitmap (sigma=2.0)', 1000 * secs))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# single entry point for the pipeline stages, e.g.
+#   ./bnn.py train --run r12 ...
+#   ./bnn.py predict --run r12 --image-dir imgs/ --output-label-db p.db --then eval --label-db labels.db
+# stages chained with --then run in this one process, sharing one restored model per run and one
+# connection per label db. --run and --image-dir, if not given to a chained stage, are taken from
+# the previous stage that had them.
+
+import importlib
+import sys
+
+from label_db import LabelDB
+
+# subcommand -> module with a main(argv, context) (or main(argv)) to run it
+SUBCOMMANDS = {
+    'train': 'train',
+    'predict': 'predict',
+    'eval': 'test',
+    'materialise': 'materialise_label_db',
+    'db': 'label_db',
+    'bench': 'benchmark',
+}
+# subcommands whose main takes a context, and the options each shares with the other stages in a
+# chain, i.e. passes on to later stages / takes from earlier ones when not given explicitly
+INHERITED_OPTIONS = {
+    'train': ['--run'],
+    'predict': ['--run', '--image-dir'],
+    'eval': ['--run', '--image-dir'],
+}
+
+USAGE = """usage: bnn.py SUBCOMMAND [ARGS ...] [--then SUBCOMMAND [ARGS ...] ...]
+
+subcommands: %s
+run 'bnn.py SUBCOMMAND --help' for the args of each""" % ", ".join(SUBCOMMANDS)
+
+
+class Context(object):
+    # state shared between the stages of one bnn.py invocation
+    def __init__(self):
+        self.models = {}  # { run: (train_opts, model), ... }
+        self.label_dbs = {}  # { filename: LabelDB, ... }
+        self.inherited = {}  # { option: value, ... } see INHERITED_OPTIONS
+
+    def restore_model(self, run):
+        if run not in self.models:
+            import model
+            self.models[run] = model.restore_model(run)
+        return self.models[run]
+
+    def forget_model(self, run):
+        # e.g. after training has saved newer weights
+        self.models.pop(run, None)
+
+    def label_db(self, label_db_file):
+        if label_db_file not in self.label_dbs:
+            self.label_dbs[label_db_file] = LabelDB(label_db_file=label_db_file)
+        return self.label_dbs[label_db_file]
+
+
+def split_stages(argv):
+    # ['predict', '--run', 'r', '--then', 'eval', ...] -> [['predict', '--run', 'r'], ['eval', ...]]
+    stages = [[]]
+    for arg in argv:
+        if arg == '--then':
+            stages.append([])
+        else:
+            stages[-1].append(arg)
+    return stages
+
+
+def with_inherited_options(subcommand, args, context):
+    # fill in INHERITED_OPTIONS from earlier stages, and remember any given here for later ones
+    args = list(args)
+    for option in INHERITED_OPTIONS[subcommand]:
+        given = [idx for idx, a in enumerate(args) if a == option or a.startswith(option + '=')]
+        if given:
+            idx = given[-1]
+            if '=' in args[idx]:
+                context.inherited[option] = args[idx].split('=', 1)[1]
+            elif idx + 1 < len(args) and not args[idx + 1].startswith('-'):
+                context.inherited[option] = args[idx + 1]
+            # else no value; the subcommand's parser reports it
+        elif option in context.inherited and '--help' not in args and '-h' not in args:
+            args = [option, context.inherited[option]] + args
+    return args
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    stages = split_stages(argv)
+    for stage in stages:
+        if len(stage) == 0 or stage[0] not in SUBCOMMANDS:
+            print(USAGE, file=sys.stderr)
+            sys.exit(2)
+
+    context = Context()
+    for subcommand, *args in stages:
+        module = importlib.import_module(SUBCOMMANDS[subcommand])
+        if subcommand in INHERITED_OPTIONS:
+            module.main(with_inherited_options(subcommand, args, context), context=context)
+        else:
+            module.main(args)
+
+
+if __name__ == '__main__':
+    main()
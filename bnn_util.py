@@ -4,9 +4,10 @@ from pathlib import Path
 
 import numpy as np
 from PIL import Image, ImageDraw
-from skimage import measure
-import tensorflow as tf
-import yaml
+
+# NOTE: tensorflow, skimage & yaml are imported only in the functions that need them. they take
+#       seconds to import and most users of this module (e.g. materialise_label_db.py) need none
+#       of them. see check_import_time.py
 
 
 # Example input and output:
@@ -22,15 +23,79 @@ def get_path_relative_to_drive(filepath):
     return str(filepath)
 
 
-def xys_to_bitmap(xys, height, width, rescale=1.0):
-    # Note: include trailing 1 dim to easier match model output
-    bitmap = np.zeros((int(height * rescale), int(width * rescale), 1), dtype=np.float32)
-    for x, y in xys:
-        try:
-            bitmap[int(y * rescale), int(x * rescale), 0] = 1.0  # recall images are (height, width)
-        except IndexError as e:
-            print('IndexError: are --height and --width correct?')
-            raise e
+def output_stride(opts):
+    # how many input pixels per output pixel (in each dimension) for a run's training opts
+    return opts.get('output_stride', 2)
+
+
+def pad_multiple(opts):
+    # what input width / height must be a multiple of for a run's training opts
+    return 2 ** opts.get('encoder_depth', 4)
+
+
+class ImagePreprocessor(object):
+    # decodes images straight into a reusable float32 buffer, zero padded up to a multiple of
+    # pad_multiple (the model downsamples encoder_depth times, so needs multiples of 2**that) and scaled
+    # -1.0 -> 1.0 (see generate_training_data.py). avoids allocating a handful of full res
+    # float arrays per image; the only per image allocation is the decoded uint8 pixels.
+    # NOTE: the returned array is overwritten by the next call.
+    def __init__(self, pad_multiple=16):
+        self.pad_multiple = pad_multiple
+        self.buffer = None
+
+    def __call__(self, filename):
+        return self.normalise(self.decode(filename))
+
+    def decode(self, filename):
+        img = Image.open(filename)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return np.asarray(img)  # uint8 0->255  (H, W, 3)
+
+    def normalise(self, pixels):
+        h, w, _ = pixels.shape
+        padded_h = -(-h // self.pad_multiple) * self.pad_multiple
+        padded_w = -(-w // self.pad_multiple) * self.pad_multiple
+        if self.buffer is None or self.buffer.shape != (padded_h, padded_w, 3):
+            self.buffer = np.zeros((padded_h, padded_w, 3), dtype=np.float32)
+        elif (h, w) != (padded_h, padded_w):
+            # a previous image with the same padded size may have written into our padding
+            self.buffer[h:] = 0.0
+            self.buffer[:, w:] = 0.0
+        out = self.buffer[:h, :w]
+        np.multiply(pixels, 1.0 / 127.5, out=out, dtype=np.float32)  # 0.0 -> 2.0
+        np.subtract(out, 1.0, out=out)  # -1.0 -> 1.0
+        return self.buffer
+
+
+def xys_to_bitmap(xys, height, width, rescale=1.0, sigma=None, classes=None, num_classes=1):
+    # Note: include trailing 1 dim (num_classes in general) to easier match model output
+    # xys are rescaled then each either sets a single pixel to 1.0 or, if sigma is set, is splatted
+    # as a gaussian (peak 1.0, overlapping splats combined with max). classes, if set, gives the
+    # channel for each xy.
+    bitmap = np.zeros((int(height * rescale), int(width * rescale), num_classes), dtype=np.float32)
+    xys = np.asarray(xys, dtype=np.float64).reshape(-1, 2) * rescale
+    classes = np.zeros(len(xys), dtype=np.int64) if classes is None else np.asarray(classes, dtype=np.int64)
+    xs, ys = xys[:, 0].astype(np.int64), xys[:, 1].astype(np.int64)  # truncates, as int() does
+    bitmap_h, bitmap_w = bitmap.shape[:2]
+    if np.any((xs < 0) | (xs >= bitmap_w) | (ys < 0) | (ys >= bitmap_h)):
+        print('IndexError: are --height and --width correct?')
+        raise IndexError("label outside of %dx%d bitmap" % (bitmap_w, bitmap_h))
+
+    if sigma is None:
+        bitmap[ys, xs, classes] = 1.0  # recall images are (height, width)
+        return bitmap
+
+    # (2r+1, 2r+1) window around each point's pixel, masked to those inside the bitmap
+    r = int(math.ceil(3 * sigma))
+    offsets = np.arange(-r, r + 1)
+    window_ys, window_xs = np.broadcast_arrays(ys[:, None, None] + offsets[None, :, None],
+                                               xs[:, None, None] + offsets[None, None, :])
+    kernel = np.exp(-(offsets[:, None] ** 2 + offsets[None, :] ** 2) / (2 * sigma ** 2)).astype(np.float32)
+    values = np.broadcast_to(kernel, window_ys.shape[:1] + kernel.shape)
+    window_classes = np.broadcast_to(classes[:, None, None], values.shape)
+    mask = (window_ys >= 0) & (window_ys < bitmap_h) & (window_xs >= 0) & (window_xs < bitmap_w)
+    np.maximum.at(bitmap, (window_ys[mask], window_xs[mask], window_classes[mask]), values[mask])
     return bitmap
 
 
@@ -45,23 +110,25 @@ def bitmap_to_pil_image(bitmap):
     assert bitmap.dtype == np.float32
     h, w, c = bitmap.shape
     assert c == 1
-    rgb_array = np.zeros((h, w, 3), dtype=np.uint8)
-    single_channel = bitmap[:, :, 0] * 255
-    rgb_array[:, :, 0] = single_channel
-    rgb_array[:, :, 1] = single_channel
-    rgb_array[:, :, 2] = single_channel
-    return Image.fromarray(rgb_array)
+    single_channel = np.uint8(bitmap[:, :, 0] * 255)
+    return Image.fromarray(single_channel, mode='L').convert('RGB')
 
 
 def zero_centered_array_to_pil_image(orig_array):
     assert orig_array.dtype == np.float32
     h, w, c = orig_array.shape
     assert c == 3
-    array = orig_array + 1  # 0.0 -> 2.0
-    array *= 127.5  # 0.0 -> 255.0
-    array = array.copy().astype(np.uint8)
-    assert np.min(array) >= 0
-    assert np.max(array) <= 255
+    # convert in blocks of rows through a small scratch buffer, rather than via full size float
+    # temporaries, and cast straight into the uint8 output
+    array = np.empty((h, w, 3), dtype=np.uint8)
+    rows = max(1, (1 << 20) // (w * 3))
+    scratch = np.empty((min(rows, h), w, 3), dtype=np.float32)
+    for start in range(0, h, rows):
+        block = scratch[:len(orig_array[start:start + rows])]
+        np.add(orig_array[start:start + rows], 1.0, out=block)  # 0.0 -> 2.0
+        block *= 127.5  # 0.0 -> 255.0
+        np.clip(block, 0, 255, out=block)  # e.g. augmentation overshoot mustn't wrap
+        np.copyto(array[start:start + rows], block, casting='unsafe')
     return Image.fromarray(array)
 
 
@@ -86,11 +153,13 @@ def side_by_side(rgb, bitmap):
 
 
 def latest_checkpoint_in_dir(ckpt_dir):
+    import yaml
     checkpoint_info = yaml.load(open("%s/checkpoint" % ckpt_dir).read())
     return checkpoint_info['model_checkpoint_path']
 
 
 def explicit_summaries(tag_values):
+    import tensorflow as tf
     values = [tf.compat.v1.Summary.value(tag=tag, simple_value=value) for tag, value in tag_values.items()]
     return tf.compat.v1.Summary.value(value=values)
 
@@ -202,6 +271,8 @@ def centroids_of_connected_components(bitmap, threshold=0.05, rescale=1.0):
     #       see https://gist.github.com/matpalm/20a3974ceb7f632f935285262fac4e98
     # TODO: hunt down the x/y swap between PIL and label db :/
 
+    from skimage import measure
+
     # threshold
     mask = bitmap > threshold
     bitmap = np.zeros_like(bitmap)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+# guard against the label tooling & db utilities regressing to slow startup; imports each light
+# weight module in a fresh interpreter with `python -X importtime` and fails if it pulls in any
+# of the heavy packages, or takes longer than --max-secs in total.
+
+import argparse
+import subprocess
+import sys
+
+# modules that should start fast, i.e. never import HEAVY_PACKAGES at module level
+LIGHT_MODULES = ['bnn', 'bnn_util', 'label_db', 'labels', 'image_discovery', 'timing', 'materialise_label_db',
+                 'label_index', 'tile_pyramid', 'suggestions', 'checkpointing',
+                 'teacher_heatmaps', 'prune', 'inference', 'export_onnx']
+HEAVY_PACKAGES = ['tensorflow', 'tensorflow_addons', 'keras', 'skimage', 'scipy', 'rawpy', 'yaml']
+
+
+def import_times(module):
+    # returns ({ top level import: cumulative microseconds, ... }, set of all modules imported)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        # e.g. "import time:       350 |      12345 |   numpy"
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imported.add(name.strip())
+        if not name.startswith('  '):  # nested imports are indented further
+            times[name.strip()] = int(cumulative_us)
+    return times, imported
+
+
+parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+parser.add_argument('--max-secs', type=float, default=1.0, help='max total import time per module')
+opts = parser.parse_args()
+
+failures = []
+for module in LIGHT_MODULES:
+    times, imported = import_times(module)
+    total_secs = sum(times.values()) / 1e6
+    heavy = sorted(set(HEAVY_PACKAGES) & {name.split('.')[0] for name in imported})
+    slowest = sorted(times.items(), key=lambda kv: -kv[1])[:3]
+    print("%-22s %6.3fs  slowest %s" % (module, total_secs, ", ".join("%s=%.3fs" % (n, us / 1e6)
+                                                                        for n, us in slowest)))
+    if heavy:
+        failures.append("%s imports %s" % (module, heavy))
+    if total_secs > opts.max_secs:
+        failures.append("%s took %.3fs to import (max %.3fs)" % (module, total_secs, opts.max_secs))
+
+if failures:
+    print("\n".join(failures), file=sys.stderr)
+    sys.exit(1)
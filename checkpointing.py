@@ -0,0 +1,167 @@
+# checkpoints for train.py, written on a background thread so training doesn't wait on disk.
+# each checkpoint is a snapshot of the model & optimizer weights (as numpy arrays, taken on the
+# training thread, so cheap and consistent) plus the global step, saved as ckpts/<run>/ckpt-<step>.npz.
+# ckpts/<run>/checkpoints.json lists them, oldest first, along with the metrics they were saved with.
+# after each save only the last keep_last, and the keep_best best by best_metric, are kept.
+# when training ends, rather than being stopped, the index is marked finished.
+
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+
+INDEX_FILE = 'checkpoints.json'
+
+
+def read_index(ckpt_dir):
+    # [{'file': ..., 'step': ..., 'metrics': {...}}, ...] oldest first, or [] if none yet
+    index_file = os.path.join(ckpt_dir, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return []
+    with open(index_file) as f:
+        return json.load(f)['checkpoints']
+
+
+def training_finished(ckpt_dir):
+    # True once the run's training has ended and its last checkpoint is written
+    index_file = os.path.join(ckpt_dir, INDEX_FILE)
+    if not os.path.exists(index_file):
+        return False
+    with open(index_file) as f:
+        return json.load(f).get('finished', False)
+
+
+def latest_checkpoint(ckpt_dir):
+    # path of newest checkpoint in ckpt_dir, or None
+    checkpoints = read_index(ckpt_dir)
+    return os.path.join(ckpt_dir, checkpoints[-1]['file']) if checkpoints else None
+
+
+def load_checkpoint(path):
+    # (step, [model weight, ...], [optimizer weight, ...])
+    with np.load(path) as ckpt:
+        model_weights = [ckpt['model_%d' % i] for i in range(int(ckpt['num_model_weights']))]
+        optimizer_weights = [ckpt['optimizer_%d' % i] for i in range(int(ckpt['num_optimizer_weights']))]
+        return int(ckpt['step']), model_weights, optimizer_weights
+
+
+def optimizer_variables(optimizer):
+    # a method in older keras, a property in newer
+    variables = optimizer.variables
+    return variables() if callable(variables) else variables
+
+
+def set_model_and_optimizer_weights(model, model_weights, optimizer_weights):
+    """Restore weights from load_checkpoint into a compiled model, including the optimizer's slots
+    and iteration count, which it only creates on its first step.
+    """
+    import tensorflow as tf
+    model.set_weights(model_weights)
+    if optimizer_weights:
+        # a step of zero gradients creates the slots without changing any weights (for adam, which
+        # scales by its zero first moment). run in replica context, as with a distribution strategy
+        # apply_gradients has to be
+        variables = model.trainable_variables
+
+        def zero_step():
+            model.optimizer.apply_gradients(zip([tf.zeros_like(v) for v in variables], variables))
+        tf.distribute.get_strategy().run(zero_step)
+        for variable, weight in zip(optimizer_variables(model.optimizer), optimizer_weights):
+            variable.assign(weight)
+
+
+class CheckpointWriter(threading.Thread):
+    def __init__(self, ckpt_dir, keep_last=5, keep_best=0, best_metric='train_loss', best_mode='min'):
+        threading.Thread.__init__(self, daemon=True)
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.best_metric = best_metric
+        self.best_mode = best_mode
+        self.checkpoints = read_index(ckpt_dir)
+        # at most one snapshot waiting behind the one being written; if disk can't keep up
+        # training waits rather than piling up copies of the weights in memory
+        self.queue = queue.Queue(maxsize=1)
+        self.error = None
+        self.start()
+
+    def save(self, step, model, metrics=None):
+        """Snapshot model (and its optimizer's) weights now, write them in the background."""
+        self._raise_if_failed()
+        optimizer = getattr(model, 'optimizer', None)  # not set until compiled
+        optimizer_weights = [v.numpy() for v in optimizer_variables(optimizer)] if optimizer is not None else []
+        self.queue.put((step, model.get_weights(), optimizer_weights, dict(metrics or {})))
+
+    def flush(self):
+        # block until everything queued so far is written
+        self.queue.join()
+        self._raise_if_failed()
+
+    def close(self, finished=False):
+        # finished => training is over, so mark the index as such
+        self.queue.put(None)
+        self.join()
+        self._raise_if_failed()
+        if finished and self.checkpoints:
+            self._write_index(finished=True)
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise RuntimeError('background checkpoint write failed') from self.error
+
+    def _write(self, step, model_weights, optimizer_weights, metrics):
+        filename = 'ckpt-%09d.npz' % step
+        arrays = {'step': step, 'num_model_weights': len(model_weights),
+                  'num_optimizer_weights': len(optimizer_weights)}
+        arrays.update(('model_%d' % i, w) for i, w in enumerate(model_weights))
+        arrays.update(('optimizer_%d' % i, w) for i, w in enumerate(optimizer_weights))
+        # write then rename, so a checkpoint is never seen half written
+        tmp_file = os.path.join(self.ckpt_dir, filename + '.tmp')
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, os.path.join(self.ckpt_dir, filename))
+
+        self.checkpoints = [c for c in self.checkpoints if c['file'] != filename]
+        self.checkpoints.append({'file': filename, 'step': step, 'metrics': metrics})
+        keep = self._retained()
+        for c in self.checkpoints:
+            if c['file'] not in keep:
+                os.remove(os.path.join(self.ckpt_dir, c['file']))
+        self.checkpoints = [c for c in self.checkpoints if c['file'] in keep]
+        self._write_index()
+
+    def _write_index(self, finished=False):
+        index = {'checkpoints': self.checkpoints}
+        if finished:
+            index['finished'] = True
+        tmp_file = os.path.join(self.ckpt_dir, INDEX_FILE + '.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f, indent=2)
+        os.replace(tmp_file, os.path.join(self.ckpt_dir, INDEX_FILE))
+
+    def _retained(self):
+        # files of the last keep_last checkpoints, and the keep_best best by best_metric
+        keep = {c['file'] for c in self.checkpoints[-self.keep_last:]} if self.keep_last > 0 else set()
+        if self.keep_best > 0:
+            scored = [c for c in self.checkpoints if self.best_metric in c['metrics']]
+            scored.sort(key=lambda c: c['metrics'][self.best_metric], reverse=self.best_mode == 'max')
+            keep.update(c['file'] for c in scored[:self.keep_best])
+        # never leave a run without its latest checkpoint
+        keep.add(self.checkpoints[-1]['file'])
+        return keep
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    print('failed to write checkpoint for step %d: %s' % (item[0], e))
+                    self.error = e
+            finally:
+                self.queue.task_done()
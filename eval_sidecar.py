@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# evaluate a training run's checkpoints as they are written, in a separate (low priority) process
+# so training never waits on it. polls ckpts/<run> and, for the newest checkpoint not yet
+# evaluated, runs test.pr_stats at full resolution and writes precision / recall / f1 and debug
+# images to tb/<run>/test at the checkpoint's step. checkpoints written while one is being
+# evaluated are skipped in favour of the newest. the model is built once, each checkpoint's weights
+# loaded into it. exits once training has finished and its last checkpoint is evaluated, or when no
+# new checkpoint has appeared for --idle-secs (e.g. training was killed). e.g. alongside train.py --run r12 ...
+#   ./eval_sidecar.py --run r12 --image-dir data/test --label-db data/labels.db
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import checkpointing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--run', type=str, required=True, help='training run to evaluate')
+    parser.add_argument('--image-dir', type=str, required=True, help='test images')
+    parser.add_argument('--label-db', type=str, required=True, help='label_db for test P/R/F1 stats')
+    parser.add_argument('--connected-components-threshold', type=float, default=None,
+                        help='if not set, the one the run was trained with')
+    parser.add_argument('--poll-secs', type=float, default=30, help='seconds between checks for new checkpoints')
+    parser.add_argument('--nice', type=int, default=10, help='increment to this process\'s niceness')
+    parser.add_argument('--num-threads', type=int, default=None,
+                        help='if set, limit tensorflow to this many threads, leaving the rest for training')
+    parser.add_argument('--until-step', type=int, default=None,
+                        help='exit after evaluating a checkpoint at or past this step. if not set, the --steps'
+                             ' of the run')
+    parser.add_argument('--idle-secs', type=float, default=3600,
+                        help='exit if no new checkpoint is written for this long. 0 => never')
+    parser.add_argument('--once', action='store_true', help='evaluate the latest checkpoint and exit')
+    opts = parser.parse_args(argv)
+
+    os.nice(opts.nice)
+
+    import tensorflow as tf
+    import model as m
+    import test
+
+    if opts.num_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(opts.num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(opts.num_threads)
+
+    ckpt_dir = "ckpts/%s" % opts.run
+    with open("%s/opts.json" % ckpt_dir) as f:
+        train_opts = json.load(f)
+    threshold = opts.connected_components_threshold
+    if threshold is None:
+        threshold = train_opts['connected_components_threshold']
+    until_step = opts.until_step if opts.until_step is not None else train_opts['steps']
+
+    test_summaries_writer = tf.summary.create_file_writer("tb/%s/test" % opts.run)
+    model = None
+    last_step = None
+    last_new_checkpoint_time = time.time()
+    while True:
+        # read before the index, so a finish marked after the read is seen next poll
+        finished = checkpointing.training_finished(ckpt_dir)
+        checkpoints = checkpointing.read_index(ckpt_dir)
+        evaluate = False
+        if checkpoints and checkpoints[-1]['step'] != last_step:
+            last_new_checkpoint_time = time.time()
+            step = checkpoints[-1]['step']
+            ckpt = os.path.join(ckpt_dir, checkpoints[-1]['file'])
+            start_time = time.time()
+            try:
+                if model is None:
+                    _train_opts, model = m.restore_model(opts.run, ckpt=ckpt)
+                else:
+                    _step, model_weights, _optimizer_weights = checkpointing.load_checkpoint(ckpt)
+                    model.set_weights(model_weights)
+                evaluate = True
+            except FileNotFoundError:
+                # removed by the retention policy since the index was read; try the newer one next poll
+                print("checkpoint for step %d already removed" % step)
+        if evaluate:
+            stats = test.pr_stats(opts.run, opts.image_dir, opts.label_db, threshold, model=model)
+            with test_summaries_writer.as_default():
+                for k in ['precision', 'recall', 'f1']:
+                    tf.summary.scalar(k, stats[k], step=step)
+                for idx, img in enumerate(stats['debug_imgs']):
+                    tf.summary.image("debug_img_%d" % idx, np.expand_dims(np.array(img), 0), step=step)
+            test_summaries_writer.flush()
+            print("\t".join(["step %d" % step,
+                             "eval_time %.1f" % (time.time() - start_time),
+                             "test stats { p:%0.2f, r:%0.2f, f1:%0.2f }" % tuple(stats[k] for k in
+                                                                                ['precision', 'recall', 'f1'])]))
+            sys.stdout.flush()
+            last_step = step
+            if step >= until_step:
+                break
+        if opts.once:
+            break
+        if finished and checkpoints and checkpoints[-1]['step'] == last_step:
+            print("training finished")
+            break
+        if opts.idle_secs > 0 and time.time() - last_new_checkpoint_time > opts.idle_secs:
+            print("no new checkpoint for %d secs; exiting" % opts.idle_secs)
+            break
+        time.sleep(opts.poll_secs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+# export a run's restored model to onnx, for predict.py / test.py --backend onnx. the model is
+# exported with free height & width, as restore_model builds it, and checked against tensorflow
+# on a random image before being written. the step of the checkpoint it's exported from is recorded
+# in the model's metadata, so inference.load_backend can warn when the run has trained on since. e.g.
+#   ./export_onnx.py --run r12   # writes ckpts/r12/model.onnx
+
+import argparse
+import os
+
+import numpy as np
+
+import bnn_util as u
+import checkpointing
+import inference
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--run', type=str, required=True, help='run to export')
+    parser.add_argument('--output', type=str, default=None, help='if not set, ckpts/<run>/model.onnx')
+    parser.add_argument('--opset', type=int, default=13, help='onnx opset to target')
+    parser.add_argument('--check-width', type=int, default=768, help='width of image to check outputs on')
+    parser.add_argument('--check-height', type=int, default=1024, help='height of image to check outputs on')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='max abs difference in logits allowed')
+    opts = parser.parse_args(argv)
+
+    import onnx
+    import tensorflow as tf
+    import tf2onnx
+    import model as m
+
+    # restore a specific checkpoint, so the step recorded is the one exported even if training
+    # writes another meanwhile. runs from before checkpoints.json have no step to record
+    ckpt_dir = "ckpts/%s" % opts.run
+    checkpoints = checkpointing.read_index(ckpt_dir)
+    ckpt = os.path.join(ckpt_dir, checkpoints[-1]['file']) if checkpoints else None
+    train_opts, model = m.restore_model(opts.run, ckpt=ckpt)
+    output = opts.output or inference.onnx_model_file(opts.run)
+    input_signature = [tf.TensorSpec((None, None, None, 3), tf.float32, name='inputs')]
+    model_proto, _external_tensor_storage = tf2onnx.convert.from_keras(model, input_signature=input_signature,
+                                                                       opset=opts.opset)
+    if checkpoints:
+        metadata = model_proto.metadata_props.add()
+        metadata.key = inference.CHECKPOINT_STEP_KEY
+        metadata.value = str(checkpoints[-1]['step'])
+    onnx.save(model_proto, output)
+
+    # same outputs as tensorflow, on an image padded as predict.py would
+    pad = u.pad_multiple(train_opts)
+    height, width = -(-opts.check_height // pad) * pad, -(-opts.check_width // pad) * pad
+    img = np.random.uniform(-1, 1, size=(height, width, 3)).astype(np.float32)
+    tf_logits = inference.TFBackend(model).predict(img)
+    onnx_logits = inference.ONNXBackend(output).predict(img)
+    max_diff = float(np.abs(tf_logits - onnx_logits).max())
+    print("wrote %s; max abs difference from tensorflow %g" % (output, max_diff))
+    if max_diff > opts.tolerance:
+        raise Exception("onnx model differs from tensorflow by %g (more than --tolerance %g)" % (max_diff, opts.tolerance))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,46 +1,86 @@
 #!/usr/bin/env python3
 
 import os
+import random
 
 import tensorflow as tf
 import tensorflow_addons as tfa
 
 import bnn_util
+from image_discovery import iter_image_files
+from teacher_heatmaps import heatmap_filename
+
+# number of random ops applied per example, see op_seed
+NUM_RANDOM_OPS = 6
 
 
 def img_xys_iterator(image_dir, label_dir, batch_size, patch_width_height, distort_rgb,
-                     flip_left_right, random_rotation, repeat, label_rescale=0.5):
+                     flip_left_right, random_rotation, repeat, label_rescale=0.5, seed=None, skip_batches=0,
+                     num_shards=1, shard_index=0, teacher_heatmap_dir=None):
     # return dataset of (image, xys_bitmap) for training
+    # if teacher_heatmap_dir is set, the teacher_heatmaps.py heatmap of each image is a second
+    # channel of xys_bitmap, cropped & augmented along with the labels
+    # if num_shards > 1, only images in shard shard_index (e.g. of this worker) are included
+    # every random choice (shuffle order, crops, augmentation) is a function of seed and the
+    # position of the example in the stream, so a stream with the same seed started with
+    # skip_batches carries on exactly where an earlier one that produced skip_batches batches stopped.
+
+    if seed is None:
+        seed = random.randrange(2 ** 31)
 
     # materialise list of rgb filenames and corresponding numpy bitmaps
     rgb_filenames = []  # (H, W, 3) pngs
     bitmap_filenames = []  # (H/2, W/2, 1) pngs
-    for fname in os.listdir(image_dir):
+    # note: materialise_label_db.py writes bitmaps flat, named after the image basename
+    for fname in iter_image_files(image_dir):
         rgb_filename = os.path.join(image_dir, fname)
-        bitmap_filename = os.path.join(label_dir, os.path.splitext(fname)[0] + '_train_bitmap_bugs.png')
+        bitmap_filename = os.path.join(label_dir,
+                                       os.path.splitext(os.path.basename(fname))[0] + '_train_bitmap_bugs.png')
         if not os.path.isfile(bitmap_filename):
             raise Exception(
                 "label bitmap img [%s] doesn't exist for training example [%s]. did you run materialise_label_db.py?"
                 % (bitmap_filename, rgb_filename))
         rgb_filenames.append(rgb_filename)
         bitmap_filenames.append(bitmap_filename)
-
-    def decode_images(rgb_f, bitmap_f):
+    rgb_filenames = rgb_filenames[shard_index::num_shards]
+    bitmap_filenames = bitmap_filenames[shard_index::num_shards]
+    label_channels = 1
+    examples = (tf.constant(rgb_filenames), tf.constant(bitmap_filenames))
+    if teacher_heatmap_dir is not None:
+        heatmap_filenames = [heatmap_filename(f, teacher_heatmap_dir) for f in rgb_filenames]
+        for rgb_filename, heatmap_f in zip(rgb_filenames, heatmap_filenames):
+            if not os.path.isfile(heatmap_f):
+                raise Exception("teacher heatmap [%s] doesn't exist for training example [%s]."
+                                " did you run teacher_heatmaps.py?" % (heatmap_f, rgb_filename))
+        label_channels = 2
+        examples += (tf.constant(heatmap_filenames),)
+
+    def op_seed(idx, op):
+        # seed for the op'th random op applied to example idx
+        return tf.stack([tf.constant(seed, tf.int64), idx * NUM_RANDOM_OPS + op])
+
+    def decode_images(idx, example):
+        rgb_f, bitmap_f = example[:2]
         rgb = tf.image.decode_image(tf.io.read_file(rgb_f))
         rgb = tf.cast(rgb, tf.float32)
         rgb = (rgb / 127.5) - 1.0  # -1.0 -> 1.0
         bitmap = tf.image.decode_image(tf.io.read_file(bitmap_f))
         bitmap = tf.cast(bitmap, tf.float32)
         bitmap /= 256  # 0 -> 1
-        return rgb, bitmap
-
-    def random_crop(rgb, bitmap):
+        if teacher_heatmap_dir is not None:
+            heatmap = tf.io.decode_png(tf.io.read_file(example[2]), dtype=tf.uint16)
+            heatmap = tf.cast(heatmap, tf.float32) / 65535  # 0 -> 1
+            bitmap = tf.concat([bitmap, heatmap], axis=-1)
+        return idx, (rgb, bitmap)
+
+    def random_crop(idx, example):
+        rgb, bitmap = example
         # we want to use the same crop for both RGB input and bitmap labels
         if patch_width_height is not None:
             patch_width = patch_height = patch_width_height
             height, width = tf.shape(rgb)[0], tf.shape(rgb)[1]
-            offset_height = tf.random.uniform([], 0, height - patch_height, dtype=tf.int32)
-            offset_width = tf.random.uniform([], 0, width - patch_width, dtype=tf.int32)
+            offset_height = tf.random.stateless_uniform([], op_seed(idx, 0), 0, height - patch_height, dtype=tf.int32)
+            offset_width = tf.random.stateless_uniform([], op_seed(idx, 1), 0, width - patch_width, dtype=tf.int32)
             rgb = tf.image.crop_to_bounding_box(rgb, offset_height, offset_width, patch_height, patch_width)
             rgb = tf.reshape(rgb, (patch_height, patch_width, 3))
             # TODO: remove this cast uglyness :/
@@ -50,46 +90,56 @@ def img_xys_iterator(image_dir, label_dir, batch_size, patch_width_height, disto
                 tf.cast(tf.cast(offset_width, tf.float32) * label_rescale, tf.int32),
                 int(patch_height * label_rescale), int(patch_width * label_rescale)
             )
-            bitmap = tf.reshape(bitmap, (int(patch_height * label_rescale), int(patch_width * label_rescale), 1))
-        return rgb, bitmap
+            bitmap = tf.reshape(bitmap, (int(patch_height * label_rescale), int(patch_width * label_rescale),
+                                         label_channels))
+        return idx, (rgb, bitmap)
 
-    def augment(rgb, bitmap):
+    def augment(idx, example):
+        rgb, bitmap = example
         if flip_left_right:
-            random = tf.random.uniform([], 0, 1, dtype=tf.float32)
+            random = tf.random.stateless_uniform([], op_seed(idx, 2), 0, 1, dtype=tf.float32)
             rgb, bitmap = tf.cond(random < 0.5,
                                   lambda: (rgb, bitmap),
                                   lambda: (tf.image.flip_left_right(rgb),
                                            tf.image.flip_left_right(bitmap)))
         if distort_rgb:
-            rgb = tf.image.random_brightness(rgb, 0.1)
-            rgb = tf.image.random_contrast(rgb, 0.9, 1.1)
+            rgb = tf.image.stateless_random_brightness(rgb, 0.1, op_seed(idx, 3))
+            rgb = tf.image.stateless_random_contrast(rgb, 0.9, 1.1, op_seed(idx, 4))
             #    rgb = tf.image.per_image_standardization(rgb)  # works great, but how to have it done for predict?
             rgb = tf.clip_by_value(rgb, clip_value_min=-1.0, clip_value_max=1.0)
 
         if random_rotation:
             # we want to use the same crop for both RGB input and bitmap labels
-            random_rotation_angle = tf.random.uniform([], -0.4, 0.4, dtype=tf.float32)
+            random_rotation_angle = tf.random.stateless_uniform([], op_seed(idx, 5), -0.4, 0.4, dtype=tf.float32)
             rgb, bitmap = (tfa.image.rotate(rgb, random_rotation_angle),
                            tfa.image.rotate(bitmap, random_rotation_angle))
 
-        return rgb, bitmap
+        return idx, (rgb, bitmap)
 
-    dataset = tf.data.Dataset.from_tensor_slices((tf.constant(rgb_filenames),
-                                                  tf.constant(bitmap_filenames)))
+    dataset = tf.data.Dataset.from_tensor_slices(examples)
 
-    dataset = dataset.map(decode_images, num_parallel_calls=8)
+    # small datasets are decoded once and cached, large ones are shuffled as filenames and
+    # decoded as needed, which also makes skipping to skip_batches cheap.
+    cache = repeat and len(rgb_filenames) < 1000
+    if cache:
+        dataset = dataset.map(lambda *example: decode_images(0, example)[1], num_parallel_calls=8).cache()
 
     if repeat:
-        if len(rgb_filenames) < 1000:
-            dataset = dataset.cache()
-        print("len(rgb_filenames)", len(rgb_filenames), ("CACHE" if len(rgb_filenames) < 1000 else "NO CACHE"))
-        dataset = dataset.shuffle(1000).repeat()
+        print("len(rgb_filenames)", len(rgb_filenames), ("CACHE" if cache else "NO CACHE"))
+        dataset = dataset.shuffle(len(rgb_filenames), seed=seed).repeat()
+
+    dataset = dataset.enumerate().skip(skip_batches * batch_size)
+
+    if not cache:
+        dataset = dataset.map(decode_images, num_parallel_calls=8)
 
     dataset = dataset.map(random_crop, num_parallel_calls=8)
 
     if flip_left_right or distort_rgb or random_rotation:
         dataset = dataset.map(augment, num_parallel_calls=8)
 
+    dataset = dataset.map(lambda idx, example: example)
+
     # NOTE: keras.fit wants the iterator directly (not .get_next())
     return dataset.batch(batch_size).prefetch(tf.data.experimental.AUTOTUNE)
 
@@ -0,0 +1,85 @@
+import json
+import os
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif', '.cr2')
+
+
+def _scan_dir(path, extensions):
+    # return sorted (files, dirs) names directly in path. a trailing '/' is used as the
+    # sort key for dirs so that walking dirs in order gives the same order as sorting
+    # full paths, e.g. 'a.png' < 'a/b.png'
+    files, dirs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir():
+                dirs.append(entry.name)
+            elif entry.name.lower().endswith(extensions):
+                files.append(entry.name)
+    return sorted(files), sorted(dirs)
+
+
+def iter_image_files(root, recursive=True, extensions=IMAGE_EXTENSIONS, index_file=None):
+    """Lazily yield image paths under root, relative to root, in sorted order.
+
+    If index_file is given the (files, dirs) listing of each directory is cached there
+    keyed by directory mtime, so later calls only re-list directories that changed.
+    The index is written once the generator is exhausted.
+    """
+    old_index = {}
+    if index_file is not None and os.path.exists(index_file):
+        with open(index_file) as f:
+            old_index = json.load(f)
+        if old_index.get('extensions') != list(extensions):
+            old_index = {}
+    old_dirs = old_index.get('dirs', {})
+    new_dirs = {}
+
+    def listing(rel_dir):
+        path = os.path.join(root, rel_dir)
+        mtime = os.stat(path).st_mtime
+        cached = old_dirs.get(rel_dir)
+        if cached is not None and cached['mtime'] == mtime:
+            files, dirs = cached['files'], cached['dirs']
+        else:
+            files, dirs = _scan_dir(path, extensions)
+        new_dirs[rel_dir] = {'mtime': mtime, 'files': files, 'dirs': dirs}
+        return files, dirs
+
+    def walk(rel_dir):
+        files, dirs = listing(rel_dir)
+        if not recursive:
+            dirs = []
+        entries = [(f, False) for f in files] + [(d + '/', True) for d in dirs]
+        for name, is_dir in sorted(entries):
+            if is_dir:
+                yield from walk(os.path.join(rel_dir, name[:-1]))
+            else:
+                yield os.path.join(rel_dir, name)
+
+    yield from walk('')
+
+    if index_file is not None:
+        if not recursive:
+            # keep cached listings of the sub directories we didn't visit this time
+            new_dirs = {**old_dirs, **new_dirs}
+        tmp_file = index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'extensions': list(extensions), 'dirs': new_dirs}, f)
+        os.replace(tmp_file, index_file)
+
+
+def list_image_files(root, recursive=True, extensions=IMAGE_EXTENSIONS, index_file=None):
+    return list(iter_image_files(root, recursive=recursive, extensions=extensions, index_file=index_file))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--image-dir', type=str, required=True)
+    parser.add_argument('--no-recursive', action='store_true', help='only list images directly in --image-dir')
+    parser.add_argument('--index-file', type=str, default=None, help='if set, cache directory listings here')
+    opts = parser.parse_args()
+
+    for filename in iter_image_files(opts.image_dir, recursive=not opts.no_recursive, index_file=opts.index_file):
+        print(filename)
@@ -0,0 +1,86 @@
+# inference backends for predict.py and test.py. a backend runs a run's model on one image,
+# predict(img) -> logits, (H, W, 3) -> (H/output_stride, W/output_stride, 1), either with
+# tensorflow ('tf') or with onnxruntime ('onnx') from a model exported by export_onnx.py. the
+# onnx backend never imports tensorflow, so inference only boxes need neither it nor its
+# startup time. exported models record the step of the checkpoint they were exported from, and
+# loading one warns if the run has a newer checkpoint since.
+
+import json
+import os
+
+import numpy as np
+
+import checkpointing
+
+BACKENDS = ['tf', 'onnx']
+
+# onnx model metadata key export_onnx.py records the checkpoint step under
+CHECKPOINT_STEP_KEY = 'checkpoint_step'
+
+
+def onnx_model_file(run):
+    # where export_onnx.py writes a run's model by default
+    return "ckpts/%s/model.onnx" % run
+
+
+def read_train_opts(run):
+    with open("ckpts/%s/opts.json" % run) as f:
+        return json.load(f)
+
+
+class TFBackend(object):
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, img):
+        # calling the model directly skips model.predict's per call setup, which for a single
+        # image costs more than the forward pass
+        return self.model(np.expand_dims(img, 0), training=False).numpy()[0]
+
+
+class ONNXBackend(object):
+    def __init__(self, model_file, intra_op_threads=0, inter_op_threads=0):
+        # threads of 0 => onnxruntime's default
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+        step = self.session.get_modelmeta().custom_metadata_map.get(CHECKPOINT_STEP_KEY)
+        self.checkpoint_step = int(step) if step is not None else None
+
+    def predict(self, img):
+        return self.session.run(None, {self.input_name: np.expand_dims(img, 0)})[0][0]
+
+
+def add_backend_args(parser):
+    # the options of load_backend
+    parser.add_argument('--backend', type=str, default='tf', choices=BACKENDS, help='what to run the model with')
+    parser.add_argument('--onnx-model', type=str, default=None,
+                        help='with --backend onnx, the exported model. if not set, the one export_onnx.py writes'
+                             ' for --run')
+    parser.add_argument('--intra-op-threads', type=int, default=0,
+                        help='with --backend onnx, threads used within an op. 0 => one per core')
+    parser.add_argument('--inter-op-threads', type=int, default=0,
+                        help='with --backend onnx, threads used to run ops in parallel. 0 => default')
+
+
+def load_backend(run, backend='tf', onnx_model=None, intra_op_threads=0, inter_op_threads=0, context=None):
+    """(train_opts, backend) for run. context, if set, is a bnn.Context whose restored model
+    the tf backend shares.
+    """
+    if backend == 'onnx':
+        model_file = onnx_model or onnx_model_file(run)
+        onnx_backend = ONNXBackend(model_file, intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+        checkpoints = checkpointing.read_index(os.path.dirname(onnx_model_file(run)))
+        if checkpoints and checkpoints[-1]['step'] != onnx_backend.checkpoint_step:
+            print("WARNING: %s was exported from the checkpoint at step %s but run %s's latest is step %d;"
+                  " rerun export_onnx.py" % (model_file, onnx_backend.checkpoint_step, run, checkpoints[-1]['step']))
+        return read_train_opts(run), onnx_backend
+    if context is not None:
+        train_opts, model = context.restore_model(run)
+    else:
+        import model as m
+        train_opts, model = m.restore_model(run)
+    return train_opts, TFBackend(model)
@@ -1,8 +1,41 @@
+import queue
 import sqlite3
+import threading
 
 from labels import Bug, Tickmark, TickmarkNumber
 
 
+class LabelChanges(object):
+    # labels added to & removed from one image since it was last saved; adding then removing
+    # the same label (or vice versa) cancels out
+    def __init__(self):
+        self.added = {}  # { key: Label, ... }
+        self.removed = {}  # { key: Label, ... }
+
+    @staticmethod
+    def key(label):
+        if isinstance(label, TickmarkNumber):
+            return type(label), label.x, label.y, label.width, label.height, label.value
+        return type(label), label.x, label.y
+
+    def add(self, label):
+        key = self.key(label)
+        if key in self.removed:
+            del self.removed[key]
+        else:
+            self.added[key] = label
+
+    def remove(self, label):
+        key = self.key(label)
+        if key in self.added:
+            del self.added[key]
+        else:
+            self.removed[key] = label
+
+    def __bool__(self):
+        return bool(self.added) or bool(self.removed)
+
+
 class LabelDB(object):
     def __init__(self, label_db_file='data/labels.db', check_same_thread=True):
         self.conn = sqlite3.connect(label_db_file, check_same_thread=check_same_thread)
@@ -37,6 +70,14 @@ class LabelDB(object):
         except sqlite3.OperationalError:
             # assume table already exists? clumsy...
             pass
+        # added after the original schema, so created separately for existing dbs
+        c.execute('''create table if not exists predictions (
+                      filename text primary key,
+                      mtime real,
+                      size integer,
+                      run text
+                 )''')
+        self.conn.commit()
 
     def has_been_created(self):
         c = self.conn.cursor()
@@ -87,6 +128,36 @@ class LabelDB(object):
                  where i.filename=?''', (img,))
         return c.fetchall()
 
+    def get_labels(self, img):
+        # ([(x, y), ...] bugs, [(x, y), ...] tickmarks, [(x, y, w, h, value), ...] tickmark numbers)
+        # exactly as stored, i.e. unlike get_bugs etc. regardless of has_labels
+        img_id = self._id_for_img(img)
+        if img_id is None:
+            return [], [], []
+        c = self.conn.cursor()
+        c.execute('select x, y from bugs where image_id=?', (img_id,))
+        bugs = c.fetchall()
+        c.execute('select x, y from tickmarks where image_id=?', (img_id,))
+        tickmarks = c.fetchall()
+        c.execute('select x, y, width, height, tickmark_value from tickmark_numbers where image_id=?', (img_id,))
+        tickmark_numbers = c.fetchall()
+        return bugs, tickmarks, tickmark_numbers
+
+    def bugs_by_img(self):
+        # { filename: [(x, y), ...], ... } for all images with bugs, in a single query
+        c = self.conn.cursor()
+        c.execute('''select i.filename, b.x, b.y
+                 from bugs b join images i on b.image_id = i.id''')
+        bugs = {}
+        for filename, x, y in c.fetchall():
+            bugs.setdefault(filename, []).append((x, y))
+        return bugs
+
+    def complete_imgs(self):
+        c = self.conn.cursor()
+        c.execute('select filename from images where complete')
+        return set(map(lambda f: f[0], c.fetchall()))
+
     def set_complete(self, img, complete):
         c = self.conn.cursor()
         c.execute('update images set complete=? where filename=?', (complete, img,))
@@ -101,6 +172,29 @@ class LabelDB(object):
         else:
             return bool(complete[0])
 
+    def apply_label_changes(self, img, added, removed, complete):
+        # add & remove individual labels, and set complete, for img in a single transaction
+        with self.conn:
+            c = self.conn.cursor()
+            img_id = self._id_for_img(img)
+            if img_id is None:
+                c.execute('insert into images (filename, complete) values (?, ?)', (img, False,))
+                img_id = c.lastrowid
+            for label in removed:
+                # match every column, so only rows identical to label are removed; all of them, as the
+                # db can hold duplicates (e.g. from predict.py) that would otherwise bring it back
+                if isinstance(label, TickmarkNumber):
+                    table = 'tickmark_numbers'
+                    where = 'image_id=? and x=? and y=? and width is ? and height is ? and tickmark_value is ?'
+                    values = (img_id, label.x, label.y, label.width, label.height, label.value)
+                else:
+                    table = {Bug: 'bugs', Tickmark: 'tickmarks'}[type(label)]
+                    where = 'image_id=? and x=? and y=?'
+                    values = (img_id, label.x, label.y)
+                c.execute('delete from %s where %s' % (table, where), values)
+            self._insert_rows_for_labels(c, img_id, added)
+            c.execute('update images set complete=? where id=?', (complete, img_id))
+
     def set_labels(self, img, labels, flip=False):
         img_id = self._id_for_img(img)
         if img_id is None:
@@ -109,6 +203,18 @@ class LabelDB(object):
             self._delete_labels_for_img_id(img_id)
         self._add_rows_for_labels(img_id, labels, flip_x_y=flip)
 
+    def get_prediction_record(self, img):
+        # (mtime, size, run) of the source file when predictions were last written, or None
+        c = self.conn.cursor()
+        c.execute('select mtime, size, run from predictions where filename=?', (img,))
+        return c.fetchone()
+
+    def set_prediction_record(self, img, mtime, size, run):
+        c = self.conn.cursor()
+        c.execute('insert or replace into predictions (filename, mtime, size, run) values (?, ?, ?, ?)',
+                  (img, mtime, size, run))
+        self.conn.commit()
+
     def _id_for_img(self, img):
         c = self.conn.cursor()
         c.execute('select id from images where filename=?', (img,))
@@ -133,11 +239,17 @@ class LabelDB(object):
 
     def _add_rows_for_labels(self, img_id, labels, flip_x_y=False):
         c = self.conn.cursor()
+        self._insert_rows_for_labels(c, img_id, labels, flip_x_y)
+        self.conn.commit()
+
+    @staticmethod
+    def _insert_rows_for_labels(c, img_id, labels, flip_x_y=False):
         for label in labels:
             x, y = label
             if flip_x_y:
                 x, y = y, x
-            if isinstance(label, Bug):
+            # plain (x, y) tuples, e.g. centroids from predict.py, are bugs
+            if isinstance(label, (Bug, tuple)):
                 c.execute('insert into bugs (image_id, x, y) values (?, ?, ?)', (img_id, x, y,))
             elif isinstance(label, Tickmark):
                 c.execute('insert into tickmarks (image_id, x, y) values (?, ?, ?)', (img_id, x, y,))
@@ -145,15 +257,78 @@ class LabelDB(object):
                 w, h, v = label.width, label.height, label.value
                 c.execute('insert into tickmark_numbers (image_id, x, y, width, height, tickmark_value) '
                           'values (?, ?, ?, ?, ?, ?)', (img_id, x, y, w, h, v))
-        self.conn.commit()
 
 
-if __name__ == '__main__':
+class BackgroundLabelWriter(threading.Thread):
+    # applies LabelDB.apply_label_changes on a thread with its own connection, so callers (e.g.
+    # the labelling UI) never wait on sqlite. images with writes still queued are tracked so
+    # callers can wait for them (flush) before reading those images back.
+    def __init__(self, label_db_file):
+        threading.Thread.__init__(self, daemon=True)
+        self.label_db_file = label_db_file
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending_imgs = {}  # { img: number of queued writes, ... }
+        self.error = None
+        self.start()
+
+    def write(self, img, added, removed, complete):
+        self._raise_if_failed()
+        with self.lock:
+            self.pending_imgs[img] = self.pending_imgs.get(img, 0) + 1
+        self.queue.put((img, list(added), list(removed), complete))
+
+    def has_pending(self, img):
+        with self.lock:
+            return img in self.pending_imgs
+
+    def flush(self):
+        # block until everything queued so far is written
+        self.queue.join()
+        self._raise_if_failed()
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        self._raise_if_failed()
+
+    def _raise_if_failed(self):
+        if self.error is not None:
+            raise RuntimeError('background label write failed') from self.error
+
+    def run(self):
+        db = LabelDB(label_db_file=self.label_db_file)
+        # WAL lets the caller's connection keep reading while we write
+        db.conn.execute('pragma journal_mode=wal')
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                img, added, removed, complete = item
+                try:
+                    db.apply_label_changes(img, added, removed, complete)
+                except Exception as e:
+                    print('failed to write labels for %s: %s' % (img, e))
+                    self.error = e
+                with self.lock:
+                    self.pending_imgs[img] -= 1
+                    if self.pending_imgs[img] == 0:
+                        del self.pending_imgs[img]
+            finally:
+                self.queue.task_done()
+
+
+def main(argv=None):
     import argparse
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--label-db', type=str, default='data/labels.db')
-    opts = parser.parse_args()
+    opts = parser.parse_args(argv)
     db = LabelDB(label_db_file=opts.label_db)
 
     print('\n'.join(db.imgs()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+import bisect
+import collections
+import math
+
+
+class LabelIndex:
+    """Labels keyed by (x, y), as a dict, plus a grid hash for finding the label nearest a point
+    and running counts of each label type
+    """
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self._labels = {}  # { (x, y): Label, ... }
+        self._cells = collections.defaultdict(set)  # { (cell_x, cell_y): {(x, y), ...}, ... }
+        self._counts = collections.Counter()  # { label type: count, ... }
+
+    def _cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def __setitem__(self, xy, label):
+        if xy in self._labels:
+            self.pop(xy)
+        self._labels[xy] = label
+        self._cells[self._cell(*xy)].add(xy)
+        self._counts[type(label)] += 1
+
+    def __getitem__(self, xy):
+        return self._labels[xy]
+
+    def __contains__(self, xy):
+        return xy in self._labels
+
+    def __len__(self):
+        return len(self._labels)
+
+    def keys(self):
+        return self._labels.keys()
+
+    def values(self):
+        return self._labels.values()
+
+    def items(self):
+        return self._labels.items()
+
+    def pop(self, xy):
+        label = self._labels.pop(xy)
+        cell = self._cell(*xy)
+        self._cells[cell].discard(xy)
+        if not self._cells[cell]:
+            del self._cells[cell]
+        self._counts[type(label)] -= 1
+        return label
+
+    def clear(self):
+        self._labels.clear()
+        self._cells.clear()
+        self._counts.clear()
+
+    def count(self, label_type):
+        return self._counts[label_type]
+
+    def nearest(self, x, y):
+        """Return the (x, y) key of the label closest to x, y, or None if there are no labels.
+        Searches rings of cells outwards from the one containing x, y, stopping once no
+        unsearched cell can hold anything closer than the best found so far.
+        """
+        if len(self._labels) == 0:
+            return None
+        cx, cy = self._cell(x, y)
+        closest_point = None
+        closest_sqr_distance = math.inf
+        num_seen = 0
+        ring = 0
+        while True:
+            for cell in self._ring_cells(cx, cy, ring):
+                for px, py in self._cells.get(cell, ()):
+                    num_seen += 1
+                    sqr_distance = (x - px) ** 2 + (y - py) ** 2
+                    if sqr_distance < closest_sqr_distance:
+                        closest_point = (px, py)
+                        closest_sqr_distance = sqr_distance
+            # anything in ring + 1 is at least ring * cell_size away
+            if num_seen == len(self._labels) or closest_sqr_distance <= (ring * self.cell_size) ** 2:
+                return closest_point
+            ring += 1
+
+    @staticmethod
+    def _ring_cells(cx, cy, ring):
+        if ring == 0:
+            yield cx, cy
+            return
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
+
+
+class CompletionIndex:
+    """Which of a (sorted) list of files are incomplete, for jumping to the next or previous
+    incomplete file without going back to the database
+    """
+    def __init__(self, files, complete_files):
+        self.num_files = len(files)
+        self.incomplete_idxs = [idx for idx, f in enumerate(files) if f not in complete_files]
+
+    def num_complete(self):
+        return self.num_files - len(self.incomplete_idxs)
+
+    def is_complete(self, idx):
+        i = bisect.bisect_left(self.incomplete_idxs, idx)
+        return i == len(self.incomplete_idxs) or self.incomplete_idxs[i] != idx
+
+    def set_complete(self, idx, complete):
+        if complete == self.is_complete(idx):
+            return
+        if complete:
+            del self.incomplete_idxs[bisect.bisect_left(self.incomplete_idxs, idx)]
+        else:
+            bisect.insort(self.incomplete_idxs, idx)
+
+    def next_incomplete(self, idx):
+        # index of first incomplete file after idx, or None
+        i = bisect.bisect_right(self.incomplete_idxs, idx)
+        return self.incomplete_idxs[i] if i < len(self.incomplete_idxs) else None
+
+    def previous_incomplete(self, idx):
+        # index of last incomplete file before idx, or None
+        i = bisect.bisect_left(self.incomplete_idxs, idx)
+        return self.incomplete_idxs[i - 1] if i > 0 else None
@@ -1,17 +1,139 @@
 import argparse
+import collections
+import concurrent.futures
 import math
 import os
 import sys
 
-from PIL import Image
-from PIL.ImageQt import ImageQt
-from PyQt5.QtCore import Qt, QRectF, pyqtSignal, QPoint
-from PyQt5.QtGui import QImage, QPixmap, QPainterPath, QPen, QBrush, QFont, QFontMetrics
-from PyQt5.QtWidgets import QApplication, QGraphicsView, QGraphicsScene, QInputDialog, QGraphicsPixmapItem, QFileDialog
-import rawpy
+import numpy as np
+from PyQt5.QtCore import Qt, QRectF, pyqtSignal, QPoint, QTimer
+from PyQt5.QtGui import QImage, QPixmap, QPainter, QPainterPath, QPen, QBrush, QFont, QFontMetrics
+from PyQt5.QtWidgets import QApplication, QGraphicsView, QGraphicsScene, QInputDialog, QFileDialog, \
+    QGraphicsItem, QGraphicsItemGroup, QGraphicsRectItem, QGraphicsTextItem
 
 from labels import Bug, Tickmark, TickmarkNumber
-from label_db import LabelDB
+from label_index import LabelIndex, CompletionIndex
+from label_db import LabelDB, LabelChanges, BackgroundLabelWriter
+from image_discovery import iter_image_files
+from tile_pyramid import TilePyramid, DEFAULT_CACHE_DIR, prune_cache
+from suggestions import ModelSuggestions, LabelDBSuggestions
+
+
+class MarkerLayer(QGraphicsItem):
+    """A single scene item painting every square marker of one label type, rather than one
+    QGraphicsRectItem per label. Only markers inside the exposed area are drawn.
+    """
+    def __init__(self, pen, brush, parent=None):
+        QGraphicsItem.__init__(self, parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)  # so exposedRect is set in paint
+        self.pen = pen
+        self.brush = brush
+        self.size = 1
+        self.bounds = QRectF()
+        self.points = {}  # { (x, y): None, ... } used as an insertion ordered set
+        self._xys = None  # points as (N, 2) array, rebuilt on paint after any change
+
+    def set_geometry(self, bounds, size):
+        self.prepareGeometryChange()
+        self.bounds = QRectF(bounds)
+        self.size = size
+
+    def boundingRect(self):
+        return self.bounds.adjusted(-self.size, -self.size, self.size, self.size)
+
+    def _marker_rect(self, x, y):
+        return QRectF(x - self.size // 2, y - self.size // 2, self.size, self.size)
+
+    def add_marker(self, x, y):
+        self.points[(x, y)] = None
+        self._xys = None
+        self.update(self._marker_rect(x, y))
+
+    def remove_marker(self, x, y):
+        del self.points[(x, y)]
+        self._xys = None
+        self.update(self._marker_rect(x, y))
+
+    def clear(self):
+        self.points.clear()
+        self._xys = None
+        self.update()
+
+    def paint(self, painter, option, widget=None):
+        if len(self.points) == 0:
+            return
+        if self._xys is None:
+            self._xys = np.array(list(self.points), dtype=np.float64).reshape(-1, 2)
+        exposed = option.exposedRect.adjusted(-self.size, -self.size, self.size, self.size)
+        xs, ys = self._xys[:, 0], self._xys[:, 1]
+        visible = (xs >= exposed.left()) & (xs <= exposed.right()) & \
+                  (ys >= exposed.top()) & (ys <= exposed.bottom())
+        painter.setPen(self.pen)
+        painter.setBrush(self.brush)
+        painter.drawRects([self._marker_rect(x, y) for x, y in self._xys[visible]])
+
+
+class TiledImageItem(QGraphicsItem):
+    """Draws an image from a TilePyramid, in full resolution scene coordinates, using only the
+    tiles covering the exposed area at the pyramid level matching the current zoom. The most
+    recently drawn tiles are kept as pixmaps, so memory use doesn't depend on image size.
+    Levels are never built while painting; until the one matching the zoom is built, the nearest
+    coarser one that is is drawn (or a placeholder, if none are), and request_level(pyramid,
+    level) is called so it can be built elsewhere.
+    """
+    def __init__(self, request_level=None, max_cached_tiles=64, parent=None):
+        QGraphicsItem.__init__(self, parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)  # so exposedRect is set in paint
+        self.request_level = request_level
+        self.max_cached_tiles = max_cached_tiles
+        self.pyramid = None
+        self.bounds = QRectF()
+        self.pixmaps = collections.OrderedDict()  # { (level, tx, ty): QPixmap, ... } least recent first
+
+    def set_pyramid(self, pyramid):
+        self.prepareGeometryChange()
+        self.pyramid = pyramid
+        self.bounds = QRectF(0, 0, pyramid.width, pyramid.height)
+        self.pixmaps.clear()
+        self.update()
+
+    def boundingRect(self):
+        return self.bounds
+
+    def _pixmap(self, level, tx, ty):
+        key = (level, tx, ty)
+        if key in self.pixmaps:
+            self.pixmaps.move_to_end(key)
+            return self.pixmaps[key]
+        tile = self.pyramid.tile(level, tx, ty)
+        data = tile.tobytes()
+        pixmap = QPixmap.fromImage(QImage(data, tile.width, tile.height, 3 * tile.width, QImage.Format_RGB888))
+        self.pixmaps[key] = pixmap
+        if len(self.pixmaps) > self.max_cached_tiles:
+            self.pixmaps.popitem(last=False)
+        return pixmap
+
+    def paint(self, painter, option, widget=None):
+        if self.pyramid is None:
+            return
+        wanted_level = self.pyramid.level_for_scale(option.levelOfDetailFromTransform(painter.worldTransform()))
+        level = self.pyramid.nearest_built_level(wanted_level)
+        if level != wanted_level and self.request_level is not None:
+            self.request_level(self.pyramid, wanted_level)
+        exposed = option.exposedRect.intersected(self.bounds)
+        if level is None:
+            painter.fillRect(exposed, Qt.darkGray)
+            return
+        scale = 2 ** level
+        extent = self.pyramid.tile_size * scale  # of one tile, in scene coordinates
+        num_x, num_y = self.pyramid.num_tiles(level)
+        painter.setClipRect(self.bounds)  # last row / column of a level can overhang by < scale pixels
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        for ty in range(int(exposed.top() // extent), min(num_y, math.ceil(exposed.bottom() / extent))):
+            for tx in range(int(exposed.left() // extent), min(num_x, math.ceil(exposed.right() / extent))):
+                pixmap = self._pixmap(level, tx, ty)
+                target = QRectF(tx * extent, ty * extent, pixmap.width() * scale, pixmap.height() * scale)
+                painter.drawPixmap(target, pixmap, QRectF(pixmap.rect()))
 
 
 class LabelUI(QGraphicsView):
@@ -27,8 +149,13 @@ class LabelUI(QGraphicsView):
     rightMouseButtonReleased = pyqtSignal(float, float)
     leftMouseButtonDoubleClicked = pyqtSignal(float, float)
     rightMouseButtonDoubleClicked = pyqtSignal(float, float)
+    # Emitted, from a background thread, with the path of an image whose suggestions are ready
+    suggestionsReady = pyqtSignal(str)
+    # Emitted, from a background thread, when a zoom level asked for while painting is built
+    tileLevelReady = pyqtSignal()
 
-    def __init__(self, label_db_filename, img_dir):
+    def __init__(self, label_db_filename, img_dir, index_file=None, autosave_secs=5, tile_cache_dir=DEFAULT_CACHE_DIR,
+                 tile_cache_max_mb=2048, suggestions=None, suggest_prefetch=3):
         QGraphicsView.__init__(self)
         self.setWindowTitle(label_db_filename)
 
@@ -39,17 +166,18 @@ class LabelUI(QGraphicsView):
             raise RuntimeError(f'Provided directory {img_dir} does not exist')
 
         self.img_dir = img_dir
-        files_list = []
-        # Walk through directory tree, get all files
-        for dir_path, dir_names, filenames in os.walk(img_dir):
-            files_list += [os.path.join(dir_path, f) for f in filenames]
-        files_list = sorted(files_list)
-        files_list = list(
-            filter(
-                lambda x: x.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif', '.cr2')),
-                files_list
-            )
-        )
+        self.tile_cache_dir = tile_cache_dir
+        self.tile_cache_max_bytes = tile_cache_max_mb * 2 ** 20
+        # Zoom levels not yet needed for display are built in the background, one image at a time,
+        # after which the cache is trimmed back to tile_cache_max_mb
+        self.tile_builder = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.tile_build = None
+        # Zoom levels the view is waiting on are built on their own thread, so they needn't wait
+        # for the background build to get to them
+        self.tile_requester = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.tile_requests = {}  # { level: Future, ... } for the current image
+        # Walk through directory tree, get all image files (sorted)
+        files_list = [os.path.join(img_dir, f) for f in iter_image_files(img_dir, index_file=index_file)]
         self.files = files_list
 
         if len(self.files) == 0:
@@ -59,8 +187,30 @@ class LabelUI(QGraphicsView):
         self.label_db = LabelDB(label_db_filename)
         self.label_db.create_if_required()
 
-        # A lookup table from bug x,y to any labels that have been added
-        self.x_y_to_labels = {}  # { (x, y): Label, ... }
+        # Which files are complete, loaded once and then kept up to date as C is pressed
+        self.completion_index = CompletionIndex(self.files, self.label_db.complete_imgs())
+
+        # Label changes are only ever written as diffs, on a background thread, so navigating
+        # never waits on the database. Unsaved changes are also written every autosave_secs.
+        self.label_writer = BackgroundLabelWriter(label_db_filename)
+        self.changes = LabelChanges()
+        self.saved_complete = False
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.save)
+        self.autosave_timer.start(int(autosave_secs * 1000))
+
+        # A lookup table from bug x,y to any labels that have been added.
+        # Spatially indexed for finding the closest label, and keeps counts of each type
+        self.x_y_to_labels = LabelIndex()  # { (x, y): Label, ... }
+
+        # Optional source of suggested bugs, e.g. from a model, shown for the current image and
+        # prepared for the next suggest_prefetch images. Suggestions are not labels until accepted
+        self.suggestions = suggestions
+        self.suggest_prefetch = suggest_prefetch
+        self.x_y_to_suggestions = LabelIndex()  # { (x, y): Bug, ... }
+        if self.suggestions is not None:
+            self.suggestions.on_ready = self.suggestionsReady.emit
+            self.suggestionsReady.connect(self.show_suggestions)
 
         # Flag to denote if bugs are being displayed or not.
         # While not displayed, we lock down all image navigation
@@ -69,12 +219,21 @@ class LabelUI(QGraphicsView):
         # Main review loop
         self.file_idx = 0
 
-        # Image is displayed as a QPixmap in a QGraphicsScene attached to this QGraphicsView
+        # Image is displayed as tiles from a TilePyramid in a QGraphicsScene attached to this QGraphicsView
         self.scene = QGraphicsScene()
         self.setScene(self.scene)
-
-        # Store a local handle to the scene's current image pixmap
-        self._pixmapHandle = None
+        self.image_item = TiledImageItem(request_level=self.request_tile_level)
+        self.scene.addItem(self.image_item)
+        self.tileLevelReady.connect(self.image_item.update)
+
+        # All label graphics live under one group, drawn over the image, so they can be shown or
+        # hidden together. Bugs and tickmarks are each drawn by a single MarkerLayer.
+        self.labels_layer = QGraphicsItemGroup()
+        self.labels_layer.setZValue(1)
+        self.scene.addItem(self.labels_layer)
+        self.bug_layer = MarkerLayer(QPen(Qt.black), QBrush(Qt.red), parent=self.labels_layer)
+        self.tickmark_layer = MarkerLayer(QPen(Qt.black), QBrush(Qt.blue), parent=self.labels_layer)
+        self.suggestion_layer = MarkerLayer(QPen(Qt.yellow, 0), QBrush(Qt.NoBrush), parent=self.labels_layer)
 
         # Scale image to fit inside viewport, preserving aspect ratio
         self.aspectRatioMode = Qt.KeepAspectRatio
@@ -99,16 +258,9 @@ class LabelUI(QGraphicsView):
 
     def update_title(self):
         name = os.path.basename(self.files[self.file_idx])
-        num_bugs = 0
-        num_tickmarks = 0
-        num_tickmark_numbers = 0
-        for label in self.x_y_to_labels.values():
-            if isinstance(label, Bug):
-                num_bugs += 1
-            elif isinstance(label, Tickmark):
-                num_tickmarks += 1
-            elif isinstance(label, TickmarkNumber):
-                num_tickmark_numbers += 1
+        num_bugs = self.x_y_to_labels.count(Bug)
+        num_tickmarks = self.x_y_to_labels.count(Tickmark)
+        num_tickmark_numbers = self.x_y_to_labels.count(TickmarkNumber)
         title = f'{name} ({self.file_idx + 1} of {len(self.files)}): '
         title += f'{num_bugs} bug'
         if num_bugs != 1:
@@ -119,45 +271,28 @@ class LabelUI(QGraphicsView):
         title += f', {num_tickmark_numbers} tickmark number'
         if num_tickmark_numbers != 1:
             title += 's'
+        if len(self.x_y_to_suggestions):
+            title += f', {len(self.x_y_to_suggestions)} suggested'
         if self.complete:
             title += ' [COMPLETE]'
+        title += f' ({self.completion_index.num_complete()} of {len(self.files)} complete)'
         self.setWindowTitle(title)
 
     def has_image(self):
-        """ Returns whether or not the scene contains an image pixmap.
-        """
-        return self._pixmapHandle is not None
-
-    def clear_image(self):
-        """ Removes the current image pixmap from the scene if it exists.
+        """ Returns whether or not the scene contains an image.
         """
-        if self.has_image():
-            self.scene.removeItem(self._pixmapHandle)
-            self._pixmapHandle = None
+        return self.image_item.pyramid is not None
 
-    def pixmap(self):
-        """ Returns the scene's current image pixmap as a QPixmap, or else None if no image exists.
-        :rtype: QPixmap | None
+    def set_image(self, pyramid):
+        """ Set the scene's current image to the input TilePyramid.
         """
-        if self.has_image():
-            return self._pixmapHandle.pixmap()
-        return None
-
-    def set_image(self, image):
-        """ Set the scene's current image pixmap to the input QImage or QPixmap.
-        Raises a RuntimeError if the input image has type other than QImage or QPixmap.
-        """
-        if type(image) is QPixmap:
-            pixmap = image
-        elif isinstance(image, QImage):
-            pixmap = QPixmap.fromImage(image)
-        else:
-            raise RuntimeError('ImageViewer.setImage: Argument must be a QImage or QPixmap.')
-        if self.has_image():
-            self._pixmapHandle.setPixmap(pixmap)
-        else:
-            self._pixmapHandle = self.scene.addPixmap(pixmap)
-        self.setSceneRect(QRectF(pixmap.rect()))  # Set scene size to image size
+        self.image_item.set_pyramid(pyramid)
+        bounds = self.image_item.boundingRect()
+        self.setSceneRect(bounds)  # Set scene size to image size
+        marker_size = pyramid.width // 300
+        self.bug_layer.set_geometry(bounds, marker_size)
+        self.tickmark_layer.set_geometry(bounds, marker_size)
+        self.suggestion_layer.set_geometry(bounds, marker_size)
         self.update_viewer()
 
     def update_viewer(self):
@@ -244,6 +379,8 @@ class LabelUI(QGraphicsView):
             self.toggle_bugs()
         elif event.key() == Qt.Key_N:
             self.display_next_incomplete_image()
+        elif event.key() == Qt.Key_P:
+            self.display_previous_incomplete_image()
         elif event.key() == Qt.Key_Q:
             self.exit_program()
         elif event.key() == Qt.Key_Escape:
@@ -251,52 +388,90 @@ class LabelUI(QGraphicsView):
             self.update_viewer()
         elif event.key() == Qt.Key_T:
             self._t_key_pressed = True
+        elif event.key() == Qt.Key_A:
+            self.accept_all_suggestions()
         elif event.key() == Qt.Key_C:
             self.complete = False if self.complete else True
+            self.completion_index.set_complete(self.file_idx, self.complete)
             self.update_title()
 
     def exit_program(self):
         self._flush_pending_x_y_to_boxes()
+        self.label_writer.close()
+        self.tile_builder.shutdown(wait=False)
+        self.tile_requester.shutdown(wait=False)
+        if self.suggestions is not None:
+            self.suggestions.close()
         QApplication.instance().quit()
 
+    def closeEvent(self, event):
+        """ Save when the window is closed too, not just on Q.
+        """
+        if self.label_writer.is_alive():
+            self.save()
+            self.label_writer.close()
+        self.tile_builder.shutdown(wait=False)
+        self.tile_requester.shutdown(wait=False)
+        if self.suggestions is not None:
+            self.suggestions.close()
+        QGraphicsView.closeEvent(self, event)
+
     def keyReleaseEvent(self, event):
         if event.key() == Qt.Key_T:
             self._t_key_pressed = False
 
     def display_image(self):
-        # Open image
+        # Open image, only its size is read here, tiles are decoded as they are drawn.
+        # The first time an image is shown each zoom level is decoded once and cached on disk
         img_name = self.files[self.file_idx]
         img_path = os.path.join(self.img_dir, img_name)
-        # If this is a raw file it gets special treatment
-        if img_path.lower().endswith('.cr2'):
-            # Read raw file
-            raw = rawpy.imread(img_path)
-            # Convert to PIL Image
-            img = Image.fromarray(raw.postprocess())
-        else:
-            img = Image.open(img_path)
-        # For some reason RGB images do not like to display in the interface.
-        # RGBA seems to work
-        img = img.convert('RGBA')
-        # Convert to QImage
-        img = ImageQt(img)
-        self.set_image(img)
+        pyramid = TilePyramid(img_path, self.tile_cache_dir)
+        for future in self.tile_requests.values():
+            future.cancel()  # no-op if already started
+        self.tile_requests = {}
+        self.set_image(pyramid)
+        if self.tile_build is not None:
+            self.tile_build.cancel()
+        self.tile_build = self.tile_builder.submit(self.build_tiles, pyramid)
 
         # Look up any existing labels in DB for this image and add them
         self.update_state_from_db(img_name)
 
+        if self.suggestions is not None:
+            self.suggestions.prefetch(self.files[self.file_idx:self.file_idx + 1 + self.suggest_prefetch])
+            self.show_suggestions(img_name)
+
+    def request_tile_level(self, pyramid, level):
+        # Called while painting
+        if level not in self.tile_requests:
+            self.tile_requests[level] = self.tile_requester.submit(self.build_tile_level, pyramid, level)
+
+    def build_tile_level(self, pyramid, level):
+        # Run on the tile requester thread
+        pyramid.build_level(level)
+        self.tileLevelReady.emit()
+
+    def build_tiles(self, pyramid):
+        # Run on the tile builder thread
+        pyramid.build()
+        prune_cache(self.tile_cache_dir, self.tile_cache_max_bytes, keep={pyramid.dir})
+
     def update_state_from_db(self, img_name):
-        existing_bugs = self.label_db.get_bugs(img_name)
+        # Only wait on the background writer if it still has changes for this image to write
+        if self.label_writer.has_pending(img_name):
+            self.label_writer.flush()
+        existing_bugs, existing_tickmarks, existing_tickmark_numbers = self.label_db.get_labels(img_name)
         for x, y in existing_bugs:
             self.add_bug_at(x, y)
-        existing_tickmarks = self.label_db.get_tickmarks(img_name)
         for x, y in existing_tickmarks:
             self.add_tickmark_at(x, y)
-        existing_tickmark_numbers = self.label_db.get_tickmark_numbers(img_name)
         for x, y, w, h, val in existing_tickmark_numbers:
             self.add_tickmark_number_at(x, y, w, h, val)
         complete = self.label_db.get_complete(img_name)
         self.complete = complete
+        # What was just loaded is, by definition, saved
+        self.changes = LabelChanges()
+        self.saved_complete = complete
         self.update_title()
 
     def display_next_image(self):
@@ -322,21 +497,26 @@ class LabelUI(QGraphicsView):
         self.display_image()
 
     def display_next_incomplete_image(self):
+        next_idx = self.completion_index.next_incomplete(self.file_idx)
+        if next_idx is None:
+            print("No incomplete images after this one.")
+            return
         self._flush_pending_x_y_to_boxes()
-        while True:
-            self.file_idx += 1
-            if self.file_idx == len(self.files):
-                print("Can't move to image past last image.")
-                self.file_idx = len(self.files) - 1
-                break
-            if not self.label_db.get_complete(self.files[self.file_idx]):
-                break
+        self.file_idx = next_idx
+        self.display_image()
+
+    def display_previous_incomplete_image(self):
+        previous_idx = self.completion_index.previous_incomplete(self.file_idx)
+        if previous_idx is None:
+            print("No incomplete images before this one.")
+            return
+        self._flush_pending_x_y_to_boxes()
+        self.file_idx = previous_idx
         self.display_image()
 
     def add_bug_at(self, x, y):
-        size = self.scene.width() // 300
-        rectangle_id = self.scene.addRect(x - size // 2, y - size // 2, size, size, QPen(Qt.black), QBrush(Qt.red))
-        self.x_y_to_labels[(x, y)] = Bug(x, y, rectangle_id)
+        self._add_label(Bug(x, y, self.bug_layer))
+        self.bug_layer.add_marker(x, y)
         self.update_title()
 
     def add_bug_event(self, e):
@@ -344,14 +524,57 @@ class LabelUI(QGraphicsView):
         if not self.display_labels:
             print('ignore add bug; labels not displayed')
             return
-        self.add_bug_at(scene_pos.x(), scene_pos.y())
+        # Clicking on a suggestion accepts it as is
+        suggestion = self._suggestion_at(scene_pos.x(), scene_pos.y())
+        if suggestion is not None:
+            self.accept_suggestion(suggestion)
+        else:
+            self.add_bug_at(scene_pos.x(), scene_pos.y())
+
+    def show_suggestions(self, img_name):
+        """ Show suggested bugs for img_name, if it is the current image and they are ready.
+        Suggestions are only shown for incomplete images, and not on top of existing labels.
+        """
+        if img_name != self.files[self.file_idx] or len(self.x_y_to_suggestions) > 0 or self.complete:
+            return
+        suggested = self.suggestions.get(img_name)
+        if suggested is None:
+            return
+        for x, y in suggested:
+            closest = self.x_y_to_labels.nearest(x, y)
+            if closest is not None and math.hypot(x - closest[0], y - closest[1]) <= self.bug_layer.size:
+                continue
+            self.suggestion_layer.add_marker(x, y)
+            self.x_y_to_suggestions[(x, y)] = Bug(x, y, self.suggestion_layer)
+        self.update_title()
+
+    def clear_suggestions(self):
+        self.suggestion_layer.clear()
+        self.x_y_to_suggestions.clear()
+
+    def _suggestion_at(self, x, y):
+        closest = self.x_y_to_suggestions.nearest(x, y)
+        if closest is not None and max(abs(x - closest[0]), abs(y - closest[1])) <= self.suggestion_layer.size:
+            return closest
+        return None
+
+    def accept_suggestion(self, xy):
+        self.x_y_to_suggestions.pop(xy)
+        self.suggestion_layer.remove_marker(*xy)
+        self.add_bug_at(*xy)
+
+    def accept_all_suggestions(self):
+        if not self.display_labels:
+            print('ignore accept suggestions; labels not displayed')
+            return
+        for xy in list(self.x_y_to_suggestions.keys()):
+            self.accept_suggestion(xy)
 
     def add_tickmark_at(self, x, y):
-        size = self.scene.width() // 300
-        rectangle_id = self.scene.addRect(x - size // 2, y - size // 2, size, size, QPen(Qt.black), QBrush(Qt.blue))
-        self.x_y_to_labels[(x, y)] = Tickmark(x, y, rectangle_id)
+        self._add_label(Tickmark(x, y, self.tickmark_layer))
+        self.tickmark_layer.add_marker(x, y)
         self.update_title()
-        
+
     def add_tickmark_event(self, e):
         scene_pos = self.mapToScene(e.pos())
         if not self.display_labels:
@@ -360,19 +583,34 @@ class LabelUI(QGraphicsView):
         self.add_tickmark_at(scene_pos.x(), scene_pos.y())
 
     def add_tickmark_number_at(self, x, y, width, height, val):
-        rectangle_id = self.scene.addRect(x, y, width, height, QPen(Qt.blue, self.scene.width() // 300))
+        rectangle_id = QGraphicsRectItem(x, y, width, height)
+        rectangle_id.setPen(QPen(Qt.blue, self.sceneRect().width() // 300))
+        self.labels_layer.addToGroup(rectangle_id)
+        # Text size scales linearly with pixel size, so measure once at a reference size and
+        # scale to the largest size that fits the box
         font = QFont()
-        font_pixel_size = 1
-        font.setPixelSize(font_pixel_size)
-        while QFontMetrics(font).boundingRect(str(val)).width() < width \
-                and QFontMetrics(font).boundingRect(str(val)).height() < height:
-            font_pixel_size += 1
-            font.setPixelSize(font_pixel_size)
-        font_pixel_size -= 1
-        number_canvas_id = self.scene.addText(str(val), font)
+        reference_pixel_size = 100
+        font.setPixelSize(reference_pixel_size)
+        text_rect = QFontMetrics(font).boundingRect(str(val))
+        scale = min(width / max(1, text_rect.width()), height / max(1, text_rect.height()))
+        font.setPixelSize(max(1, int(reference_pixel_size * scale)))
+        number_canvas_id = QGraphicsTextItem(str(val))
+        number_canvas_id.setFont(font)
         number_canvas_id.setDefaultTextColor(Qt.blue)
+        self.labels_layer.addToGroup(number_canvas_id)
         number_canvas_id.setPos(QPoint(int(x), int(y)))
-        self.x_y_to_labels[(x, y)] = TickmarkNumber(x, y, rectangle_id, width, height, val, number_canvas_id)
+        self._add_label(TickmarkNumber(x, y, rectangle_id, width, height, val, number_canvas_id))
+
+    def _add_label(self, label):
+        # a label already at this xy, of whatever type, is deleted first. called before a bug or
+        # tickmark's marker is added, so deleting one of the same type doesn't take the new marker
+        xy = (label.x, label.y)
+        if xy in self.x_y_to_labels:
+            existing = self.x_y_to_labels.pop(xy)
+            self.changes.remove(existing)
+            self.remove_label(existing)
+        self.x_y_to_labels[xy] = label
+        self.changes.add(label)
 
     def add_tickmark_number_event(self, box):
         if not self.display_labels:
@@ -381,17 +619,29 @@ class LabelUI(QGraphicsView):
         val, _ = QInputDialog.getInt(self, 'Input', 'Enter tickmark value:')
         self.add_tickmark_number_at(box.x(), box.y(), box.width(), box.height(), val)
 
+    def save(self):
+        """Queue any label changes since the last save to be written to the database
+        """
+        if not self.changes and self.complete == self.saved_complete:
+            return
+        img_name = self.files[self.file_idx]
+        self.label_writer.write(img_name, self.changes.added.values(), self.changes.removed.values(), self.complete)
+        self.changes = LabelChanges()
+        self.saved_complete = self.complete
+
     def _flush_pending_x_y_to_boxes(self):
         """Write labels to database and remove them from canvas
         """
-        img_name = self.files[self.file_idx]
         # Write to database
-        self.label_db.set_labels(img_name, self.x_y_to_labels.values())
+        self.save()
         # Remove from canvas
+        self.bug_layer.clear()
+        self.tickmark_layer.clear()
+        self.clear_suggestions()
         for label in self.x_y_to_labels.values():
-            self.remove_label(label)
+            if isinstance(label, TickmarkNumber):
+                self.remove_label(label)
         self.x_y_to_labels.clear()
-        self.label_db.set_complete(img_name, self.complete)
 
     def toggle_bugs(self):
         # if self.display_labels:
@@ -408,16 +658,15 @@ class LabelUI(QGraphicsView):
         #         self.add_bug_at(x, y)
         #     self.display_labels = True
         self.display_labels = not self.display_labels
-        for item in self.scene.items():
-            if not isinstance(item, QGraphicsPixmapItem):
-                item.setVisible(self.display_labels)
+        self.labels_layer.setVisible(self.display_labels)
 
     def remove_label(self, label):
-        canvas_id = label.canvas_id
-        self.scene.removeItem(canvas_id)
         if isinstance(label, TickmarkNumber):
-            number_canvas_id = label.number_canvas_id
-            self.scene.removeItem(number_canvas_id)
+            self.scene.removeItem(label.canvas_id)
+            self.scene.removeItem(label.number_canvas_id)
+        else:
+            # canvas_id of bugs and tickmarks is the MarkerLayer drawing them
+            label.canvas_id.remove_marker(label.x, label.y)
 
     def remove_closest_label_event(self, e):
         scene_pos = self.mapToScene(e.pos())
@@ -426,14 +675,10 @@ class LabelUI(QGraphicsView):
             return
         if len(self.x_y_to_labels) == 0:
             return
-        closest_point = None
-        closest_sqr_distance = 0.0
-        for x, y in self.x_y_to_labels.keys():
-            sqr_distance = (scene_pos.x() - x) ** 2 + (scene_pos.y() - y) ** 2
-            if sqr_distance < closest_sqr_distance or closest_point is None:
-                closest_point = (x, y)
-                closest_sqr_distance = sqr_distance
-        self.remove_label(self.x_y_to_labels.pop(closest_point))
+        closest_point = self.x_y_to_labels.nearest(scene_pos.x(), scene_pos.y())
+        label = self.x_y_to_labels.pop(closest_point)
+        self.changes.remove(label)
+        self.remove_label(label)
         self.update_title()
 
 
@@ -441,10 +686,27 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--image-dir', type=str)
     parser.add_argument('--label-db', type=str, required=True)
+    parser.add_argument('--image-index', type=str, default=None,
+                        help='if set, cache the listing of --image-dir in this file between runs')
+    parser.add_argument('--autosave-secs', type=float, default=5,
+                        help='how often unsaved label changes are written to --label-db')
+    parser.add_argument('--tile-cache-dir', type=str, default=DEFAULT_CACHE_DIR,
+                        help='where the zoom levels of each image are cached as tiles')
+    parser.add_argument('--tile-cache-max-mb', type=int, default=2048,
+                        help='least recently viewed images\' tiles are removed to keep the cache under this size')
+    suggest = parser.add_mutually_exclusive_group()
+    suggest.add_argument('--suggest-run', type=str, default=None,
+                         help='if set, show bugs predicted by the model of this run as suggestions')
+    suggest.add_argument('--suggest-label-db', type=str, default=None,
+                         help='if set, show bugs from this label db, e.g. written by predict.py --output-label-db'
+                              ' for the same --image-dir, as suggestions')
+    parser.add_argument('--suggest-prefetch', type=int, default=3,
+                        help='number of upcoming images to predict suggestions for in the background')
     args = parser.parse_args()
 
     print('''Usage:
     Left click:                      label bug
+    Left click on a suggestion:      accept suggested bug
     Left click while holding T:      label tickmark
     Drag left mouse while holding T: identify tick mark number
     Right click:                     remove nearest label
@@ -455,15 +717,27 @@ def main():
     LEFT:         previous image
     UP:           toggle display of labels
     N:            next incomplete image
+    P:            previous incomplete image
     C:            mark image as complete (all bugs and tickmarks labeled)
     T:            hold to label tickmarks and tickmark numbers
+    A:            accept all suggested bugs
     ESC:          reset zoom
     Q:            quit
     '''
           )
 
+    if args.suggest_run is not None:
+        suggestions = ModelSuggestions(args.suggest_run)
+    elif args.suggest_label_db is not None:
+        suggestions = LabelDBSuggestions(args.suggest_label_db, args.image_dir)
+    else:
+        suggestions = None
+
     app = QApplication(sys.argv)
-    _ = LabelUI(args.label_db, args.image_dir)
+    _ = LabelUI(args.label_db, args.image_dir, index_file=args.image_index,
+                autosave_secs=args.autosave_secs, tile_cache_dir=args.tile_cache_dir,
+                tile_cache_max_mb=args.tile_cache_max_mb,
+                suggestions=suggestions, suggest_prefetch=args.suggest_prefetch)
     sys.exit(app.exec_())
 
 
@@ -6,6 +6,10 @@ class Label:
         self.y = y
         self.canvas_id = canvas_id
 
+    def __iter__(self):
+        # allow unpacking as x, y = label
+        return iter((self.x, self.y))
+
 
 class Bug(Label):
     """Bug label
@@ -1,48 +1,154 @@
 #!/usr/bin/env python3
 
 # given a label_db create a single channel image corresponding to each image.
+#
+# images are processed in parallel and a manifest in --label-output-dir records, per image,
+# the source file's mtime & size and a hash of its labels so later runs only redo images
+# whose labels or source changed.
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
 import os
+import shutil
 
 from PIL import Image
 
 import bnn_util
 from label_db import LabelDB
 
-parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('--label-db', type=str, help='label_db to materialise bitmaps from', required=True)
-parser.add_argument('--image-output-dir', type=str, help='where to dump the rgb images', required=True)
-parser.add_argument('--label-output-dir', type=str, help='where to dump the label images', required=True)
-parser.add_argument('--label-rescale', type=float, default=0.5,
-                    help='relative scale of label bitmap compared to input image')
-opts = parser.parse_args()
-
-os.makedirs(opts.image_output_dir, exist_ok=True)
-os.makedirs(opts.label_output_dir, exist_ok=True)
-label_db = LabelDB(label_db_file=opts.label_db)
-
-filenames = list(label_db.imgs())
-for filename in filenames:
-    original_filename = filename
-    filename = bnn_util.get_path_relative_to_drive(filename)
-    drive_base_path = os.path.expanduser('~/data/srpa226-drive/Sharing/202012 Paul/')
-    filename = os.path.join(drive_base_path, filename)
-    if not os.path.exists(filename):
-        print(f'File not found, skipping: {filename}')
+MANIFEST_FILENAME = 'materialise_manifest.json'
+
+# formats tf.image.decode_image (see generate_training_data.py) can read directly. anything else
+# is decoded and re-saved as png.
+PASSTHROUGH_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+def labels_hash(bugs, label_rescale, sigma):
+    key = json.dumps([label_rescale, sigma, sorted(bugs)])
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def link_or_copy(src, dest):
+    # hardlink the original bytes where possible, copy if not (e.g. across filesystems)
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def output_filenames(filename, image_output_dir, label_output_dir):
+    base, ext = os.path.splitext(os.path.basename(filename))
+    if ext.lower() not in PASSTHROUGH_EXTENSIONS:
+        ext = '.png'
+    img_new_filename = os.path.join(image_output_dir, base + ext)
+    bitmap_filename = os.path.join(label_output_dir, base + '_train_bitmap_bugs.png')
+    return img_new_filename, bitmap_filename
+
+
+def materialise(filename, bugs, image_output_dir, label_output_dir, label_rescale, sigma):
+    img_new_filename, bitmap_filename = output_filenames(filename, image_output_dir, label_output_dir)
+    if filename.lower().endswith(PASSTHROUGH_EXTENSIONS):
+        # note: PIL only reads the header here, the pixels are never decoded
+        width, height = Image.open(filename).size
+        link_or_copy(filename, img_new_filename)
     else:
-        img = Image.open(filename)
+        if filename.lower().endswith('.cr2'):
+            import rawpy
+            img = Image.fromarray(rawpy.imread(filename).postprocess())
+        else:
+            img = Image.open(filename).convert('RGB')
         width, height = img.size
-        if not label_db.get_complete(original_filename):
+        img.save(img_new_filename)
+    bitmap = bnn_util.xys_to_bitmap(xys=bugs, height=height, width=width, rescale=label_rescale, sigma=sigma)
+    bnn_util.bitmap_to_single_channel_pil_image(bitmap).save(bitmap_filename)
+    return filename
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--label-db', type=str, help='label_db to materialise bitmaps from', required=True)
+    parser.add_argument('--image-output-dir', type=str, help='where to dump the rgb images', required=True)
+    parser.add_argument('--label-output-dir', type=str, help='where to dump the label images', required=True)
+    parser.add_argument('--label-rescale', type=float, default=0.5,
+                        help='relative scale of label bitmap compared to input image')
+    parser.add_argument('--gaussian-sigma', type=float, default=None,
+                        help='if set, splat each label as a gaussian with this sigma (in bitmap pixels)'
+                             ' rather than a single pixel')
+    parser.add_argument('--drive-base-path', type=str, default='~/data/srpa226-drive/Sharing/202012 Paul/',
+                        help='base dir that (relative) label_db filenames are resolved against')
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count(), help='number of processes to use')
+    parser.add_argument('--force', action='store_true', help='ignore manifest and rematerialise every image')
+    opts = parser.parse_args(argv)
+
+    os.makedirs(opts.image_output_dir, exist_ok=True)
+    os.makedirs(opts.label_output_dir, exist_ok=True)
+    label_db = LabelDB(label_db_file=opts.label_db)
+
+    manifest_filename = os.path.join(opts.label_output_dir, MANIFEST_FILENAME)
+    manifest = {}
+    if os.path.exists(manifest_filename) and not opts.force:
+        with open(manifest_filename) as f:
+            manifest = json.load(f)
+
+    # read everything we need from the db up front; the workers never touch it
+    complete_imgs = label_db.complete_imgs()
+    bugs_by_img = label_db.bugs_by_img()
+    drive_base_path = os.path.expanduser(opts.drive_base_path)
+
+    # outputs are named by basename, so two images with the same one (in different dirs, or e.g. a
+    # .cr2 and a .png) would be written by different workers at once
+    jobs = []  # [(original_filename, filename, bugs), ...]
+    output_sources = {}  # { output image filename: original_filename, ... }
+    for original_filename in sorted(label_db.imgs()):
+        filename = bnn_util.get_path_relative_to_drive(original_filename)
+        filename = os.path.join(drive_base_path, filename)
+        if not os.path.exists(filename):
+            print(f'File not found, skipping: {filename}')
+            continue
+        if original_filename not in complete_imgs:
             print(f'Image labeling not complete, skipping: {filename}')
-        else:
-            bitmap = bnn_util.xys_to_bitmap(xys=label_db.get_bugs(original_filename),
-                                            height=height, width=width,
-                                            rescale=opts.label_rescale)
-            single_channel_img = bnn_util.bitmap_to_single_channel_pil_image(bitmap)
-            print(f'Processing {filename}')
-            img_new_filename = os.path.join(opts.image_output_dir, os.path.basename(filename))
-            bitmap_filename = os.path.basename(os.path.splitext(filename)[0] + '_train_bitmap_bugs.png')
-            bitmap_filename = os.path.join(opts.label_output_dir, bitmap_filename)
-            img.save(img_new_filename)
-            single_channel_img.save(bitmap_filename)
+            continue
+        img_new_filename, _bitmap_filename = output_filenames(filename, opts.image_output_dir, opts.label_output_dir)
+        if img_new_filename in output_sources:
+            raise Exception(f'{original_filename} and {output_sources[img_new_filename]} would both be'
+                            f' materialised as {img_new_filename}; rename one')
+        output_sources[img_new_filename] = original_filename
+        jobs.append((original_filename, filename, bugs_by_img.get(original_filename, [])))
+
+    new_manifest = {}
+    pending = {}  # { future: (original_filename, manifest entry), ... }
+    num_up_to_date = 0
+    try:
+        with ProcessPoolExecutor(max_workers=opts.num_workers) as executor:
+            for original_filename, filename, bugs in jobs:
+                stat = os.stat(filename)
+                entry = {'src_mtime': stat.st_mtime,
+                         'src_size': stat.st_size,
+                         'labels_hash': labels_hash(bugs, opts.label_rescale, opts.gaussian_sigma)}
+                outputs = output_filenames(filename, opts.image_output_dir, opts.label_output_dir)
+                if manifest.get(original_filename) == entry and all(map(os.path.exists, outputs)):
+                    new_manifest[original_filename] = entry
+                    num_up_to_date += 1
+                    continue
+                future = executor.submit(materialise, filename, bugs, opts.image_output_dir,
+                                         opts.label_output_dir, opts.label_rescale, opts.gaussian_sigma)
+                pending[future] = (original_filename, entry)
+
+            for future, (original_filename, entry) in pending.items():
+                print(f'Processing {future.result()}')
+                new_manifest[original_filename] = entry
+    finally:
+        # written even if a worker fails, so the images done so far aren't redone next run
+        tmp_manifest_filename = manifest_filename + '.tmp'
+        with open(tmp_manifest_filename, 'w') as f:
+            json.dump(new_manifest, f)
+        os.replace(tmp_manifest_filename, manifest_filename)
+    print(f'Materialised {len(pending)} images, {num_up_to_date} already up to date')
+
+
+if __name__ == '__main__':
+    main()
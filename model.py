@@ -2,10 +2,12 @@ import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 import bnn_util
+import checkpointing
 import json
 
 
-def restore_model(run):
+def restore_model(run, ckpt=None):
+    # ckpt, if set, is a checkpointing checkpoint of run to restore rather than the latest
     # load opts used during training
     opts = json.loads(open("ckpts/%s/opts.json" % run).read())
 
@@ -15,19 +17,53 @@ def restore_model(run):
         height=None,
         use_skip_connections=not opts['no_use_skip_connections'],
         base_filter_size=opts['base_filter_size'],
-        use_batch_norm=not opts['no_use_batch_norm']
+        use_batch_norm=not opts['no_use_batch_norm'],
+        # runs from before these were options used the defaults
+        separable_convs=opts.get('separable_convs', False),
+        encoder_depth=opts.get('encoder_depth', 4),
+        output_stride=opts.get('output_stride', 2),
+        block_filters=opts.get('block_filters')  # set for runs made by prune.py
     )
 
-    # restore weights from latest checkpoint
-    latest_ckpt = bnn_util.latest_checkpoint_in_dir("ckpts/%s" % run)
-    model.load_weights("ckpts/%s/%s" % (run, latest_ckpt))
+    # restore weights from latest checkpoint, falling back to the save_weights checkpoints of
+    # runs from before train.py used checkpointing.CheckpointWriter
+    latest_ckpt = ckpt or checkpointing.latest_checkpoint("ckpts/%s" % run)
+    if latest_ckpt is not None:
+        _step, model_weights, _optimizer_weights = checkpointing.load_checkpoint(latest_ckpt)
+        model.set_weights(model_weights)
+    else:
+        latest_ckpt = bnn_util.latest_checkpoint_in_dir("ckpts/%s" % run)
+        model.load_weights("ckpts/%s/%s" % (run, latest_ckpt))
 
     return opts, model
 
 
+def default_block_filters(base_filter_size, encoder_depth=4, output_stride=2):
+    # filters of each conv_bn_relu_block of construct_model, encoder then decoder; each block at
+    # 1/2**n resolution has 2**(n-1) * base_filter_size
+    output_level = {2: 1, 4: 2}[output_stride]
+    levels = list(range(1, encoder_depth + 1)) + list(range(encoder_depth - 1, output_level - 1, -1))
+    return [2 ** (n - 1) * base_filter_size for n in levels]
+
+
 def construct_model(width, height, base_filter_size,
-                    use_batch_norm=True, use_skip_connections=True):
-    def conv_bn_relu_block(i, _, filters, strides):
+                    use_batch_norm=True, use_skip_connections=True,
+                    separable_convs=False, encoder_depth=4, output_stride=2, block_filters=None):
+    # a unet; encoder_depth stride 2 blocks, each doubling the filters, then a decoder back up
+    # to 1/output_stride of the input resolution (so width & height need to be multiples of
+    # 2**encoder_depth). with separable_convs all blocks but the first (which only has 3 input
+    # channels) are depthwise separable. block_filters, if set, overrides the filters of each
+    # block, encoder then decoder, e.g. with the narrower ones of a pruned model.
+    output_level = {2: 1, 4: 2}.get(output_stride)
+    if output_level is None:
+        raise Exception("output_stride must be 2 or 4, not %s" % output_stride)
+    if encoder_depth <= output_level:
+        raise Exception("encoder_depth must be more than %d for output_stride %d" % (output_level, output_stride))
+    if block_filters is None:
+        block_filters = default_block_filters(base_filter_size, encoder_depth, output_stride)
+    block_filters = iter(block_filters)
+
+    def conv_bn_relu_block(i, _, filters, strides, separable=False):
 
         # TODO: try this as more theoretically correct approach
         #    o = Conv2D(filters=filters, kernel_size=3,
@@ -36,8 +72,9 @@ def construct_model(width, height, base_filter_size,
         #    if use_batch_norm:
         #      o = BatchNormalization(scale=False)(o)
 
-        o = layers.Conv2D(filters=filters, kernel_size=3,
-                          strides=strides, padding='same')(i)
+        conv = layers.SeparableConv2D if separable else layers.Conv2D
+        o = conv(filters=filters, kernel_size=3,
+                 strides=strides, padding='same')(i)
         if use_batch_norm:
             o = layers.BatchNormalization()(o)
 
@@ -46,36 +83,35 @@ def construct_model(width, height, base_filter_size,
 
     inputs = layers.Input(shape=(height, width, 3), name='inputs')
 
-    e1 = conv_bn_relu_block(inputs, 'e1', filters=base_filter_size, strides=2)
-    e2 = conv_bn_relu_block(e1, 'e2', filters=2 * base_filter_size, strides=2)
-    e3 = conv_bn_relu_block(e2, 'e3', filters=4 * base_filter_size, strides=2)
-    e4 = conv_bn_relu_block(e3, 'e4', filters=8 * base_filter_size, strides=2)
+    # encoder; e[n] is at 1/2**n resolution with (by default) 2**(n-1) * base_filter_size filters
+    e = [inputs]
+    for n in range(1, encoder_depth + 1):
+        e.append(conv_bn_relu_block(e[-1], 'e%d' % n, filters=next(block_filters), strides=2,
+                                    separable=separable_convs and n > 1))
 
     # note: using version of keras locally that doesn't support interpolation='nearest' so
     #       unsure what resize is happening here...
 
-    d1 = layers.UpSampling2D(name='e4nn')(e4)
-    if use_skip_connections:
-        d1 = layers.Concatenate(name='d1_e3')([d1, e3])
-    d1 = conv_bn_relu_block(d1, 'd1', filters=4 * base_filter_size, strides=1)
-
-    d2 = layers.UpSampling2D(name='d1nn')(d1)
-    if use_skip_connections:
-        d2 = layers.Concatenate(name='d2_e2')([d2, e2])
-    d2 = conv_bn_relu_block(d2, 'd2', filters=2 * base_filter_size, strides=1)
-
-    d3 = layers.UpSampling2D(name='d2nn')(d2)
-    if use_skip_connections:
-        d3 = layers.Concatenate(name='d3_e1')([d3, e1])
-    d3 = conv_bn_relu_block(d3, 'd3', filters=base_filter_size, strides=1)
+    # decoder; d[m] is back up at the resolution of e[encoder_depth - m]
+    d, name = e[encoder_depth], 'e%d' % encoder_depth
+    for m, n in enumerate(range(encoder_depth - 1, output_level - 1, -1), start=1):
+        d = layers.UpSampling2D(name='%snn' % name)(d)
+        if use_skip_connections:
+            d = layers.Concatenate(name='d%d_e%d' % (m, n))([d, e[n]])
+        name = 'd%d' % m
+        d = conv_bn_relu_block(d, name, filters=next(block_filters), strides=1,
+                               separable=separable_convs)
 
     logits = layers.Conv2D(filters=1, kernel_size=1, strides=1,
-                           activation=None, name='logits')(d3)
+                           activation=None, name='logits')(d)
 
     return keras.Model(inputs=inputs, outputs=logits)
 
 
-def compile_model(model, learning_rate, pos_weight=1.0):
+def compile_model(model, learning_rate, pos_weight=1.0, distill_alpha=None, distill_temperature=1.0):
+    # if distill_alpha is set, y_true has the labels in channel 0 and a teacher's probabilities in
+    # channel 1, and the loss is (1 - distill_alpha) * weighted_xent on the labels plus distill_alpha
+    # * xent against the teacher's probabilities softened by distill_temperature
     def weighted_xent(y_true, y_predicted):
         return tf.reduce_mean(
             tf.nn.weighted_cross_entropy_with_logits(
@@ -85,6 +121,20 @@ def compile_model(model, learning_rate, pos_weight=1.0):
             )
         )
 
+    def distillation_loss(y_true, y_predicted):
+        labels, teacher_probs = y_true[..., :1], y_true[..., 1:]
+        # soften the teacher (and student) by scaling their logits down by the temperature. the
+        # T**2 keeps the soft term's gradients on the same scale whatever the temperature
+        teacher_probs = tf.clip_by_value(teacher_probs, 1e-4, 1 - 1e-4)
+        teacher_logits = tf.math.log(teacher_probs / (1 - teacher_probs))
+        soft_xent = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                labels=tf.sigmoid(teacher_logits / distill_temperature),
+                logits=y_predicted / distill_temperature
+            )
+        ) * distill_temperature ** 2
+        return (1 - distill_alpha) * weighted_xent(labels, y_predicted) + distill_alpha * soft_xent
+
     model.compile(optimizer=tf.optimizers.Adam(learning_rate=learning_rate),
-                  loss=weighted_xent)
+                  loss=weighted_xent if distill_alpha is None else distillation_loss)
     return model
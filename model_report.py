@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+# params, FLOPs and inference latency of construct_model variants, to see what a cheaper model
+# would buy before training it. each --variant is a comma separated list of construct_model
+# keyword overrides of the baseline (the train.py defaults), e.g.
+#   ./model_report.py --variant separable_convs=1 --variant encoder_depth=3,output_stride=4
+# FLOPs count the multiply-adds (as 2 FLOPs) of the convs at --width x --height; batch norm,
+# relu & upsampling are small next to them. latency is of model.predict on one image, as in
+# predict.py, with random (untrained) weights.
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+
+def conv_flops(model):
+    flops = 0
+    for layer in model.layers:
+        kind = layer.__class__.__name__
+        if kind not in ('Conv2D', 'SeparableConv2D'):
+            continue
+        in_channels = layer.input.shape[-1]
+        _, out_h, out_w, out_channels = layer.output.shape
+        kh, kw = layer.kernel_size
+        if kind == 'Conv2D':
+            macs = out_h * out_w * kh * kw * in_channels * out_channels
+        else:
+            # depthwise then 1x1 pointwise
+            macs = out_h * out_w * in_channels * (kh * kw + out_channels)
+        flops += 2 * macs
+    return flops
+
+
+def predict_latency(model, img, repeats=10):
+    # median secs of model.predict(img), after one warm up
+    model.predict(img)
+    latencies = []
+    for _ in range(repeats):
+        start_time = time.time()
+        model.predict(img)
+        latencies.append(time.time() - start_time)
+    return float(np.median(latencies))
+
+
+def parse_variant(variant):
+    # "k1=v1,k2=v2" -> {k1: int(v1), k2: int(v2)}
+    kwargs = {}
+    for key_value in variant.split(','):
+        key, value = key_value.split('=')
+        kwargs[key.strip()] = int(value)
+    return kwargs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--variant', type=str, action='append', default=[],
+                        help='construct_model overrides, e.g. separable_convs=1,encoder_depth=3. repeat for more'
+                             ' than one. the baseline is always included')
+    parser.add_argument('--base-filter-size', type=int, default=8, help='baseline base_filter_size')
+    parser.add_argument('--width', type=int, default=768, help='input width; multiple of 2**encoder_depth')
+    parser.add_argument('--height', type=int, default=1024, help='input height; multiple of 2**encoder_depth')
+    parser.add_argument('--repeats', type=int, default=10, help='timed predicts per variant, after one warm up')
+    parser.add_argument('--report', type=str, default=None, help='if set, also write results here as json')
+    opts = parser.parse_args(argv)
+
+    import model as m
+
+    baseline = {'base_filter_size': opts.base_filter_size, 'use_batch_norm': True, 'use_skip_connections': True,
+                'separable_convs': False, 'encoder_depth': 4, 'output_stride': 2}
+    variants = [('baseline', {})] + [(v, parse_variant(v)) for v in opts.variant]
+
+    img = np.random.uniform(-1, 1, size=(1, opts.height, opts.width, 3)).astype(np.float32)
+    results = []
+    for name, overrides in variants:
+        kwargs = dict(baseline, **overrides)
+        model = m.construct_model(width=opts.width, height=opts.height, **kwargs)
+        results.append({'variant': name, 'kwargs': kwargs,
+                        'params': int(model.count_params()),
+                        'gflops': conv_flops(model) / 1e9,
+                        'latency_ms': 1000 * predict_latency(model, img, opts.repeats)})
+
+    base = results[0]
+    print("%-48s %10s %8s %8s %11s %8s" % ('variant', 'params', 'gflops', 'x_flops', 'latency_ms', 'speedup'))
+    for r in results:
+        print("%-48s %10d %8.2f %8.2f %11.1f %8.2f" % (r['variant'], r['params'], r['gflops'],
+                                                        r['gflops'] / base['gflops'], r['latency_ms'],
+                                                        base['latency_ms'] / r['latency_ms']))
+
+    if opts.report is not None:
+        with open(opts.report, 'w') as f:
+            json.dump({'width': opts.width, 'height': opts.height, 'variants': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,81 +2,180 @@
 
 # given a directory of images output a list of image -> predictions
 
-from PIL import Image
 from label_db import LabelDB
 from scipy.special import expit
 import argparse
-import model as m
-import numpy as np
+import inference
 import os
 import random
+import sys
+import time
 import bnn_util as u
+from image_discovery import list_image_files
+from timing import StageTimer
 
-parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('--image-dir', type=str, required=True)
-parser.add_argument('--num', type=int, default=None,
-                    help='if set run prediction for this many random images. if not set run for all')
-parser.add_argument('--output-label-db', type=str, default=None, help='if not set dont write label_db')
-parser.add_argument('--run', type=str, required=True, help='model, also used as subdir for export-pngs')
-parser.add_argument('--export-pngs', default='',
-                    help='how, if at all, to export pngs {"", "predictions", "centroids"}')
-opts = parser.parse_args()
-
-train_opts, model = m.restore_model(opts.run)
-print(model.summary())
-
-if opts.output_label_db:
-    db = LabelDB(label_db_file=opts.output_label_db)
-    db.create_if_required()
-else:
-    db = None
-
-if opts.export_pngs:
-    export_dir = "predict_examples/%s" % opts.run
-    print("exporting prediction samples to [%s]" % export_dir)
-    if not os.path.exists(export_dir):
-        os.makedirs(export_dir)
-
-imgs = os.listdir(opts.image_dir)
-if opts.num is not None:
-    assert opts.num > 0
-    imgs = random.sample(imgs, opts.num)
-
-for idx, filename in enumerate(sorted(imgs)):
-
-    # load next image
-    img = np.array(Image.open(opts.image_dir + "/" + filename))  # uint8 0->255  (H, W)
-    img = img.astype(np.float32)
-    img = (img / 127.5) - 1.0  # -1.0 -> 1.0  # see data.py
-
-    original_shape = img.shape
-    difference = [0, 0]
-    for shape_idx in [0, 1]:
-        if original_shape[shape_idx] % 16 != 0:
-            difference[shape_idx] = 16 - original_shape[shape_idx] % 16
-    img = np.pad(img, ((0, difference[0]), (0, difference[1]), (0, 0)))
-
-    # run through model (adding / removing dummy batch)
-    # recall: output from model is logits so we need to expit
-    # TODO: do this in batch !!
-    prediction = expit(model.predict(np.expand_dims(img, 0))[0])
-
-    # calc [(x,y), ...] centroids
-    centroids = u.centroids_of_connected_components(prediction,
-                                                    rescale=2.0,
-                                                    threshold=train_opts['connected_components_threshold'])
-    print("\t".join(map(str, [idx, filename, len(centroids)])))
-
-    # export some debug image (if requested)
-    if opts.export_pngs != '':
-        if opts.export_pngs == 'predictions':
-            debug_img = u.side_by_side(rgb=img, bitmap=prediction)
-        elif opts.export_pngs == 'centroids':
-            debug_img = u.red_dots(rgb=img, centroids=centroids)
+# what reading an image that's been deleted, or isn't fully written yet, can raise
+UNREADABLE_IMAGE_ERRORS = (OSError, SyntaxError, ValueError)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--image-dir', type=str, required=True)
+    parser.add_argument('--image-index', type=str, default=None,
+                        help='if set, cache the listing of --image-dir (and its sub dirs) in this file between runs')
+    parser.add_argument('--num', type=int, default=None,
+                        help='if set run prediction for this many random images. if not set run for all')
+    parser.add_argument('--output-label-db', type=str, default=None, help='if not set dont write label_db')
+    parser.add_argument('--run', type=str, required=True, help='model, also used as subdir for export-pngs')
+    parser.add_argument('--export-pngs', default='',
+                        help='how, if at all, to export pngs {"", "predictions", "centroids"}')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip images already predicted by this --run (same mtime & size) in --output-label-db')
+    parser.add_argument('--watch', action='store_true',
+                        help='after processing existing images keep polling --image-dir for new or changed ones.'
+                             ' implies --incremental')
+    parser.add_argument('--watch-interval', type=float, default=10.0, help='seconds between polls in --watch mode')
+    inference.add_backend_args(parser)
+    parser.add_argument('--timing-trace', type=str, default=None,
+                        help='if set, write per image stage timings to this file as json lines')
+    parser.add_argument('--tf-profile-dir', type=str, default=None,
+                        help='if set, capture a tensorflow profiler trace for --tf-profile-images into this dir')
+    parser.add_argument('--tf-profile-images', type=str, default='5:10',
+                        help='start:end image indexes to capture in tensorflow profiler trace')
+    opts = parser.parse_args(argv)
+
+    if opts.watch:
+        opts.incremental = True
+    if opts.incremental and not opts.output_label_db:
+        raise Exception("--incremental / --watch require --output-label-db to record what has been predicted")
+    return opts
+
+
+def main(argv=None, context=None):
+    # context, if set, is a bnn.Context providing an already restored model & open dbs
+    opts = parse_args(argv)
+
+    train_opts, backend = inference.load_backend(opts.run, opts.backend, opts.onnx_model, opts.intra_op_threads,
+                                                 opts.inter_op_threads, context=context)
+    if context is None and opts.backend == 'tf':
+        print(backend.model.summary())
+
+    if opts.output_label_db:
+        if context is not None:
+            db = context.label_db(opts.output_label_db)
         else:
-            raise Exception("unknown --export-pngs option")
-        debug_img.save("%s/%s" % (export_dir, filename))
+            db = LabelDB(label_db_file=opts.output_label_db)
+        db.create_if_required()
+    else:
+        db = None
+
+    if opts.export_pngs:
+        export_dir = "predict_examples/%s" % opts.run
+        print("exporting prediction samples to [%s]" % export_dir)
+        if not os.path.exists(export_dir):
+            os.makedirs(export_dir)
+
+    preprocess = u.ImagePreprocessor(pad_multiple=u.pad_multiple(train_opts))
+    timer = StageTimer(trace_file=opts.timing_trace)
+    tf_profile_start, tf_profile_end = map(int, opts.tf_profile_images.split(':'))
+
+    def needs_prediction(filename):
+        # an image needs (re)predicting unless the db records this run having seen exactly this file
+        if not opts.incremental:
+            return True
+        try:
+            stat = os.stat(os.path.join(opts.image_dir, filename))
+        except OSError:
+            return False  # gone since being listed
+        record = db.get_prediction_record(filename)
+        return record != (stat.st_mtime, stat.st_size, opts.run)
+
+    def predict(idx, filename):
+        # load next image
+        try:
+            stat = os.stat(os.path.join(opts.image_dir, filename))
+            with timer.stage('decode'):
+                pixels = preprocess.decode(os.path.join(opts.image_dir, filename))
+        except UNREADABLE_IMAGE_ERRORS as e:
+            if not opts.watch:
+                raise
+            # deleted, or still being copied, since being listed. no prediction record is written
+            # so the next poll tries it again
+            print("skipping %s: %s" % (filename, e), file=sys.stderr)
+            timer.end_step(idx=idx, filename=filename, error=str(e))
+            return
+        with timer.stage('preprocess'):
+            img = preprocess.normalise(pixels)  # -1.0 -> 1.0, padded to multiple of 2**encoder_depth
+
+        # run through model (the backend adds / removes the dummy batch)
+        # recall: output from model is logits so we need to expit
+        # TODO: do this in batch !!
+        with timer.stage('inference'):
+            prediction = expit(backend.predict(img))
+
+        # calc [(x,y), ...] centroids
+        with timer.stage('postprocess'):
+            centroids = u.centroids_of_connected_components(prediction,
+                                                            rescale=u.output_stride(train_opts),
+                                                            threshold=train_opts['connected_components_threshold'])
+        print("\t".join(map(str, [idx, filename, len(centroids)])))
+
+        # export some debug image (if requested)
+        if opts.export_pngs != '':
+            with timer.stage('export'):
+                if opts.export_pngs == 'predictions':
+                    debug_img = u.side_by_side(rgb=img, bitmap=prediction)
+                elif opts.export_pngs == 'centroids':
+                    debug_img = u.red_dots(rgb=img, centroids=centroids)
+                else:
+                    raise Exception("unknown --export-pngs option")
+                export_filename = "%s/%s" % (export_dir, filename)
+                os.makedirs(os.path.dirname(export_filename), exist_ok=True)
+                debug_img.save(export_filename)
+
+        # set new labels (if requested)
+        if db:
+            with timer.stage('db_write'):
+                db.set_labels(filename, centroids, flip=True)
+                # record stat taken before reading, so a file rewritten mid predict is picked up next poll
+                db.set_prediction_record(filename, stat.st_mtime, stat.st_size, opts.run)
+
+        timer.end_step(idx=idx, filename=filename, num_centroids=len(centroids))
+
+    imgs = list_image_files(opts.image_dir, index_file=opts.image_index)
+    if opts.num is not None:
+        assert opts.num > 0
+        imgs = random.sample(imgs, opts.num)
+
+    idx = 0
+    profiling = False
+    try:
+        while True:
+            pending = [f for f in sorted(imgs) if needs_prediction(f)]
+            if opts.incremental:
+                print("%d of %d images need prediction" % (len(pending), len(imgs)))
+            for filename in pending:
+                if opts.tf_profile_dir is not None and idx == tf_profile_start:
+                    import tensorflow as tf
+                    tf.profiler.experimental.start(opts.tf_profile_dir)
+                    profiling = True
+                predict(idx, filename)
+                if profiling and idx == tf_profile_end - 1:
+                    tf.profiler.experimental.stop()
+                    profiling = False
+                idx += 1
+            if not opts.watch:
+                break
+            time.sleep(opts.watch_interval)
+            imgs = list_image_files(opts.image_dir, index_file=opts.image_index)
+    finally:
+        # also reached on ctrl-c, which is how --watch runs end
+        if profiling:
+            tf.profiler.experimental.stop()
+        timer.close()
+        if idx > 0:
+            print(timer.summary(), file=sys.stderr)
+
 
-    # set new labels (if requested)
-    if db:
-        db.set_labels(filename, centroids, flip=True)
+if __name__ == '__main__':
+    main()
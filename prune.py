@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+# shrink a trained run by removing the least important channels of each conv_bn_relu_block (ranked
+# by |batch norm gamma|, or the L1 norm of the conv's filters for runs without batch norm), then
+# briefly fine tune what's left. the result is saved as a new run, with its narrower block_filters
+# in its opts.json, that model.restore_model (and so predict.py, test.py etc) loads as any other.
+# params, FLOPs, predict latency and (if --image-dir & --label-db are set) test F1 of the original
+# and pruned models are printed and written to ckpts/<output-run>/prune_report.json. e.g.
+#   ./prune.py --run r12 --output-run r12_p50 --keep-fraction 0.5 --image-dir data/test --label-db data/labels.db
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+import bnn_util as u
+import checkpointing
+
+
+def channel_importance(conv, bn):
+    # one score per output channel of a block; higher is more important
+    if bn is not None:
+        return np.abs(bn.get_weights()[0])  # gamma
+    kernel = conv.get_weights()[1 if conv.__class__.__name__ == 'SeparableConv2D' else 0]
+    return np.abs(kernel).sum(axis=(0, 1, 2))
+
+
+def block_inputs(num_blocks, encoder_depth, use_skip_connections):
+    # for each block of construct_model, the blocks whose (concatenated) outputs are its input;
+    # None for the image
+    inputs = [[None]] + [[b - 1] for b in range(1, encoder_depth)]
+    for b in range(encoder_depth, num_blocks):
+        level = 2 * encoder_depth - 1 - b  # of the encoder block skipped across to it
+        inputs.append([b - 1, level - 1] if use_skip_connections else [b - 1])
+    return inputs
+
+
+def input_channels(inputs, keep, num_channels):
+    # indexes of the kept channels of a concatenation of blocks' outputs
+    indexes, offset = [], 0
+    for b in inputs:
+        if b is None:
+            return np.arange(3)
+        indexes.extend(offset + keep[b])
+        offset += num_channels[b]
+    return np.array(indexes)
+
+
+def prune_weights(conv, bn, in_idxs, out_idxs):
+    # weights of conv (& bn) with only the in_idxs input and out_idxs output channels
+    if conv.__class__.__name__ == 'SeparableConv2D':
+        depthwise, pointwise, bias = conv.get_weights()
+        conv_weights = [depthwise[:, :, in_idxs], pointwise[:, :, in_idxs][..., out_idxs], bias[out_idxs]]
+    else:
+        kernel, bias = conv.get_weights()
+        conv_weights = [kernel[:, :, in_idxs][..., out_idxs], bias[out_idxs]]
+    bn_weights = [w[out_idxs] for w in bn.get_weights()] if bn is not None else None
+    return conv_weights, bn_weights
+
+
+def blocks(model):
+    # [(conv, bn or None), ...] of each conv_bn_relu_block, in construction order, and the logits conv
+    convs = [l for l in model.layers if l.__class__.__name__ in ('Conv2D', 'SeparableConv2D') and l.name != 'logits']
+    bns = [l for l in model.layers if l.__class__.__name__ == 'BatchNormalization'] or [None] * len(convs)
+    return list(zip(convs, bns)), model.get_layer('logits')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--run', type=str, required=True, help='run to prune')
+    parser.add_argument('--output-run', type=str, required=True, help='run to save the pruned model as')
+    parser.add_argument('--keep-fraction', type=float, default=0.5, help='fraction of channels of each block to keep')
+    parser.add_argument('--finetune-steps', type=int, default=500, help='training steps after pruning. 0 => none')
+    parser.add_argument('--learning-rate', type=float, default=None, help='for fine tuning; if not set, the run\'s')
+    parser.add_argument('--batch-size', type=int, default=None, help='for fine tuning; if not set, the run\'s')
+    parser.add_argument('--train-image-dir', type=str, default=None, help='for fine tuning; if not set, the run\'s')
+    parser.add_argument('--label-dir', type=str, default=None, help='for fine tuning; if not set, the run\'s')
+    parser.add_argument('--image-dir', type=str, default=None, help='if set, with --label-db, test images for F1')
+    parser.add_argument('--label-db', type=str, default=None, help='label_db for test F1')
+    parser.add_argument('--width', type=int, default=768, help='image width to time predict at')
+    parser.add_argument('--height', type=int, default=1024, help='image height to time predict at')
+    opts = parser.parse_args(argv)
+
+    import model as m
+    import generate_training_data
+    from model_report import conv_flops, predict_latency
+    import test
+
+    train_opts, original = m.restore_model(opts.run)
+    encoder_depth = train_opts.get('encoder_depth', 4)
+    original_blocks, original_logits = blocks(original)
+    num_channels = [conv.filters for conv, _bn in original_blocks]
+
+    # keep the top keep_fraction of each block's channels, in their original order
+    keep = []
+    for conv, bn in original_blocks:
+        num_keep = max(1, int(round(opts.keep_fraction * conv.filters)))
+        keep.append(np.sort(np.argsort(-channel_importance(conv, bn))[:num_keep]))
+    block_filters = [len(k) for k in keep]
+    print("block filters %s -> %s" % (num_channels, block_filters))
+
+    pruned_opts = dict(train_opts, run=opts.output_run, block_filters=block_filters, pruned_from=opts.run)
+    pruned = m.construct_model(
+        width=None,
+        height=None,
+        use_skip_connections=not train_opts['no_use_skip_connections'],
+        base_filter_size=train_opts['base_filter_size'],
+        use_batch_norm=not train_opts['no_use_batch_norm'],
+        separable_convs=train_opts.get('separable_convs', False),
+        encoder_depth=encoder_depth,
+        output_stride=u.output_stride(train_opts),
+        block_filters=block_filters
+    )
+    pruned_blocks, pruned_logits = blocks(pruned)
+    inputs = block_inputs(len(keep), encoder_depth, not train_opts['no_use_skip_connections'])
+    for b, ((conv, bn), (pruned_conv, pruned_bn)) in enumerate(zip(original_blocks, pruned_blocks)):
+        conv_weights, bn_weights = prune_weights(conv, bn, input_channels(inputs[b], keep, num_channels), keep[b])
+        pruned_conv.set_weights(conv_weights)
+        if pruned_bn is not None:
+            pruned_bn.set_weights(bn_weights)
+    kernel, bias = original_logits.get_weights()
+    pruned_logits.set_weights([kernel[:, :, input_channels([len(keep) - 1], keep, num_channels)], bias])
+
+    m.compile_model(pruned,
+                    learning_rate=opts.learning_rate or train_opts['learning_rate'],
+                    pos_weight=train_opts['pos_weight'])
+    if opts.finetune_steps > 0:
+        dataset = generate_training_data.img_xys_iterator(
+            image_dir=opts.train_image_dir or train_opts['train_image_dir'],
+            label_dir=opts.label_dir or train_opts['label_dir'],
+            batch_size=opts.batch_size or train_opts['batch_size'],
+            patch_width_height=train_opts['patch_width_height'],
+            distort_rgb=True,
+            flip_left_right=train_opts['flip_left_right'],
+            random_rotation=train_opts['random_rotate'],
+            repeat=True,
+            label_rescale=1 / u.output_stride(train_opts)
+        )
+        pruned.fit(dataset, steps_per_epoch=opts.finetune_steps, epochs=1, verbose=2)
+
+    ckpt_dir = "ckpts/%s" % opts.output_run
+    os.makedirs(ckpt_dir, exist_ok=True)
+    with open("%s/opts.json" % ckpt_dir, "w") as f:
+        f.write(json.dumps(pruned_opts))
+    checkpoints = checkpointing.CheckpointWriter(ckpt_dir)
+    checkpoints.save(opts.finetune_steps, pruned)
+    checkpoints.close(finished=True)
+
+    # FLOPs need fixed size copies of the models
+    img = np.random.uniform(-1, 1, size=(1, opts.height, opts.width, 3)).astype(np.float32)
+    report = {}
+    for name, run, model in [('original', opts.run, original), ('pruned', opts.output_run, pruned)]:
+        model_at_size = m.construct_model(
+            width=opts.width, height=opts.height,
+            use_skip_connections=not train_opts['no_use_skip_connections'],
+            base_filter_size=train_opts['base_filter_size'],
+            use_batch_norm=not train_opts['no_use_batch_norm'],
+            separable_convs=train_opts.get('separable_convs', False),
+            encoder_depth=encoder_depth,
+            output_stride=u.output_stride(train_opts),
+            block_filters=block_filters if name == 'pruned' else train_opts.get('block_filters')
+        )
+        model_at_size.set_weights(model.get_weights())
+        report[name] = {'run': run,
+                        'params': int(model.count_params()),
+                        'gflops': conv_flops(model_at_size) / 1e9,
+                        'latency_ms': 1000 * predict_latency(model_at_size, img)}
+        if opts.image_dir is not None and opts.label_db is not None:
+            stats = test.pr_stats(run, opts.image_dir, opts.label_db, train_opts['connected_components_threshold'],
+                                  model=model)
+            report[name]['f1'] = stats['f1']
+
+    print("%-10s %10s %8s %11s %6s" % ('model', 'params', 'gflops', 'latency_ms', 'f1'))
+    for name, r in report.items():
+        f1 = "%6.3f" % r['f1'] if 'f1' in r else "%6s" % '-'
+        print("%-10s %10d %8.2f %11.1f %s" % (name, r['params'], r['gflops'], r['latency_ms'], f1))
+    with open("%s/prune_report.json" % ckpt_dir, "w") as f:
+        json.dump(dict(report, keep_fraction=opts.keep_fraction, finetune_steps=opts.finetune_steps,
+                       block_filters=block_filters), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
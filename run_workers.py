@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+# run a script as a cluster of local tf.distribute workers, e.g. to try, or measure the scaling of,
+# train.py --multi-worker on one box before spreading it over several.
+#   ./run_workers.py --num-workers 2 -- train.py --multi-worker --seed 123 --run r12 ...
+# each worker is the script run with TF_CONFIG describing the cluster (localhost ports) and its
+# place in it. the output of worker 0 (the chief) is shown, the rest go to <log-dir>/worker_<i>.log
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+def free_ports(n):
+    sockets = [socket.socket() for _ in range(n)]
+    for s in sockets:
+        s.bind(('localhost', 0))
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def tf_config(workers, index):
+    return json.dumps({'cluster': {'worker': workers}, 'task': {'type': 'worker', 'index': index}})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--log-dir', type=str, default='worker_logs')
+    parser.add_argument('script', type=str)
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    opts = parser.parse_args(argv)
+
+    workers = ["localhost:%d" % port for port in free_ports(opts.num_workers)]
+    os.makedirs(opts.log_dir, exist_ok=True)
+    start_time = time.time()
+    procs = []
+    for i in range(opts.num_workers):
+        env = dict(os.environ, TF_CONFIG=tf_config(workers, i))
+        out = None if i == 0 else open(os.path.join(opts.log_dir, "worker_%d.log" % i), 'w')
+        procs.append(subprocess.Popen([sys.executable, opts.script] + opts.args, env=env,
+                                      stdout=out, stderr=subprocess.STDOUT if out else None))
+    try:
+        returncodes = [p.wait() for p in procs]
+    except KeyboardInterrupt:
+        for p in procs:
+            p.terminate()
+        raise
+    print("%d workers finished in %.1fs, exit codes %s" % (opts.num_workers, time.time() - start_time, returncodes),
+          file=sys.stderr)
+    sys.exit(max(returncodes, key=abs))
+
+
+if __name__ == '__main__':
+    main()
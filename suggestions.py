@@ -0,0 +1,101 @@
+# suggested bug labels for label_ui.py, to be accepted or corrected rather than clicked from
+# scratch. either predicted in the background by a restored model (ModelSuggestions) or read from
+# a label db written by `predict.py --output-label-db` (LabelDBSuggestions), e.g. one being kept
+# up to date for the image dir by `predict.py --watch`.
+
+import concurrent.futures
+import os
+import threading
+
+import numpy as np
+
+import bnn_util as u
+from label_db import LabelDB
+
+
+class LabelDBSuggestions(object):
+    def __init__(self, label_db_file, img_dir):
+        self.label_db = LabelDB(label_db_file)
+        self.img_dir = img_dir
+        self.on_ready = None  # unused, suggestions are always ready
+
+    def prefetch(self, img_paths):
+        pass
+
+    def get(self, img_path):
+        # [(x, y), ...]; predict.py keys images relative to its --image-dir
+        bugs, _tickmarks, _tickmark_numbers = self.label_db.get_labels(os.path.relpath(img_path, self.img_dir))
+        return bugs
+
+    def close(self):
+        pass
+
+
+class ModelSuggestions(object):
+    """Predicts bugs for images with the model from a training run, one image at a time on a
+    background thread. The model is restored on that thread too, on first use.
+    """
+    def __init__(self, run):
+        self.run = run
+        self.on_ready = None  # if set, called with img_path (on the background thread) as each is done
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.results = {}  # { img_path: [(x, y), ...], ... }
+        self.pending = {}  # { img_path: Future, ... } queued or running
+        self.train_opts = None
+        self.model = None
+        self.restore_error = None  # if restoring failed; not retried for every image
+        self.preprocess = None
+        self.output_stride = None
+
+    def _restore(self):
+        if self.model is None and self.restore_error is None:
+            try:
+                import model as m
+                self.train_opts, self.model = m.restore_model(self.run)
+                self.preprocess = u.ImagePreprocessor(pad_multiple=u.pad_multiple(self.train_opts))
+                self.output_stride = u.output_stride(self.train_opts)
+            except Exception as e:
+                self.restore_error = e
+        if self.restore_error is not None:
+            raise Exception("couldn't restore run %s: %s" % (self.run, self.restore_error))
+
+    def _predict(self, img_path):
+        from scipy.special import expit
+        try:
+            self._restore()
+            img = self.preprocess(img_path)
+            prediction = expit(self.model.predict(np.expand_dims(img, 0))[0])
+            centroids = u.centroids_of_connected_components(
+                prediction, rescale=self.output_stride, threshold=self.train_opts['connected_components_threshold'])
+        except Exception as e:
+            print("no suggestions for %s: %s" % (img_path, e))
+            centroids = []
+        # centroids are (y, x), see predict.py writing them with flip=True
+        with self.lock:
+            self.results[img_path] = [(x, y) for y, x in centroids]
+            del self.pending[img_path]
+        if self.on_ready is not None:
+            self.on_ready(img_path)
+
+    def prefetch(self, img_paths):
+        """Predict img_paths, in order, dropping any still queued from an earlier prefetch."""
+        with self.lock:
+            for img_path, future in list(self.pending.items()):
+                if img_path not in img_paths and future.cancel():
+                    del self.pending[img_path]
+            for img_path in img_paths:
+                if img_path not in self.results and img_path not in self.pending:
+                    self.pending[img_path] = self.executor.submit(self._predict, img_path)
+
+    def get(self, img_path):
+        # [(x, y), ...] or None if not predicted yet
+        with self.lock:
+            return self.results.get(img_path)
+
+    def close(self):
+        # drop anything still queued; shutdown's cancel_futures needs python 3.9
+        with self.lock:
+            for future in self.pending.values():
+                future.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# cache a (large) teacher run's predictions for the training images, for distilling into a smaller
+# student with train.py --teacher-run <run> --teacher-heatmap-dir <dir> rather than running the
+# teacher alongside the student every step. each heatmap is the teacher's bug probability at
+# the resolution of the label bitmaps (--label-rescale as given to materialise_label_db.py), as a
+# 16 bit png named after the image; generate_training_data.py crops & augments it with the labels.
+#   ./teacher_heatmaps.py --run r12 --image-dir materialised/images --output-dir heatmaps/r12
+
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+from image_discovery import iter_image_files
+
+
+def heatmap_filename(image_filename, heatmap_dir):
+    return os.path.join(heatmap_dir, os.path.splitext(os.path.basename(image_filename))[0] + '_teacher_heatmap.png')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--run', type=str, required=True, help='teacher run')
+    parser.add_argument('--image-dir', type=str, required=True, help='training images, as materialised')
+    parser.add_argument('--output-dir', type=str, required=True, help='where to write heatmaps')
+    parser.add_argument('--label-rescale', type=float, default=0.5,
+                        help='relative scale of label bitmap (so heatmap) compared to input image')
+    opts = parser.parse_args(argv)
+
+    from scipy.special import expit
+    import bnn_util as u
+    import model as m
+
+    train_opts, teacher = m.restore_model(opts.run)
+    preprocess = u.ImagePreprocessor(pad_multiple=u.pad_multiple(train_opts))
+    teacher_stride = u.output_stride(train_opts)
+    os.makedirs(opts.output_dir, exist_ok=True)
+
+    for fname in iter_image_files(opts.image_dir):
+        pixels = preprocess.decode(os.path.join(opts.image_dir, fname))
+        height, width, _ = pixels.shape
+        prediction = expit(teacher.predict(np.expand_dims(preprocess.normalise(pixels), 0))[0, :, :, 0])
+        # drop the part predicted for the padding, then match the size materialise_label_db.py
+        # gives the label bitmaps (the teacher may have a different output stride)
+        prediction = prediction[:-(-height // teacher_stride), :-(-width // teacher_stride)]
+        size = (int(width * opts.label_rescale), int(height * opts.label_rescale))
+        heatmap = Image.fromarray(prediction.astype(np.float32), mode='F').resize(size, Image.BILINEAR)
+        heatmap = np.uint16(np.clip(np.asarray(heatmap), 0, 1) * 65535)
+        Image.fromarray(heatmap).save(heatmap_filename(fname, opts.output_dir))
+        print(fname)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,43 +2,51 @@
 
 # given a directory of images and labels output overall P/R/F1 for entire set
 
-from PIL import Image
 from label_db import LabelDB
 from scipy.special import expit
-import model as m
-import numpy as np
+import inference
 import os
 import bnn_util as u
+from image_discovery import list_image_files
 
 
-def pr_stats(run, image_dir, label_db, connected_components_threshold):
+def pr_stats(run, image_dir, label_db, connected_components_threshold, context=None, model=None, backend=None):
     # TODO: a bunch of this can go back into one off init in a class
-
-    _train_opts, model = m.restore_model(run)
-
-    label_db = LabelDB(label_db_file=label_db)
+    # context, if set, is a bnn.Context providing an already restored model & open dbs
+    # model, if set, is used instead of restoring the latest checkpoint of run
+    # backend, if set, is an inference backend (see inference.py) to run instead of either
+
+    if model is not None:
+        backend = inference.TFBackend(model)
+    if backend is not None:
+        train_opts = inference.read_train_opts(run)
+    else:
+        train_opts, backend = inference.load_backend(run, context=context)
+    if context is not None:
+        label_db = context.label_db(label_db)
+    else:
+        label_db = LabelDB(label_db_file=label_db)
 
     set_comparison = u.SetComparison()
 
+    preprocess = u.ImagePreprocessor(pad_multiple=u.pad_multiple(train_opts))
+
     # use 4 images for debug
     debug_imgs = []
 
-    for idx, filename in enumerate(sorted(os.listdir(image_dir))):
+    for idx, filename in enumerate(list_image_files(image_dir)):
         # load next image
-        # TODO: this block used in various places, refactor
-        img = np.array(Image.open(image_dir + "/" + filename))  # uint8 0->255  (H, W)
-        img = img.astype(np.float32)
-        img = (img / 127.5) - 1.0  # -1.0 -> 1.0  # see data.py
+        img = preprocess(os.path.join(image_dir, filename))  # -1.0 -> 1.0, padded to multiple of 2**encoder_depth
 
         # run through model
-        prediction = expit(model.predict(np.expand_dims(img, 0))[0])
+        prediction = expit(backend.predict(img))
 
         if len(debug_imgs) < 4:
             debug_imgs.append(u.side_by_side(rgb=img, bitmap=prediction))
 
         # calc [(x,y), ...] centroids
         predicted_centroids = u.centroids_of_connected_components(prediction,
-                                                                  rescale=2.0,
+                                                                  rescale=u.output_stride(train_opts),
                                                                   threshold=connected_components_threshold)
 
         # compare to true labels
@@ -54,7 +62,7 @@ def pr_stats(run, image_dir, label_db, connected_components_threshold):
             "f1": f1}
 
 
-if __name__ == "__main__":
+def main(argv=None, context=None):
     import argparse
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -62,7 +70,15 @@ if __name__ == "__main__":
     parser.add_argument('--image-dir', type=str, required=True)
     parser.add_argument('--label-db', type=str, required=True)
     parser.add_argument('--connected-components-threshold', type=float, default=0.05)
-    opts = parser.parse_args()
+    inference.add_backend_args(parser)
+    opts = parser.parse_args(argv)
     print(opts)
 
-    print(pr_stats(opts.run, opts.image_dir, opts.label_db, opts.connected_components_threshold))
+    _train_opts, backend = inference.load_backend(opts.run, opts.backend, opts.onnx_model, opts.intra_op_threads,
+                                                  opts.inter_op_threads, context=context)
+    print(pr_stats(opts.run, opts.image_dir, opts.label_db, opts.connected_components_threshold, context=context,
+                   backend=backend))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+# multi resolution tile pyramid of an image, cached on disk, so a viewer only ever needs the few
+# tiles visible at the current zoom in memory. level 0 is full resolution, each level above is half
+# the size of the one below, up to the first level that fits in a single tile. levels are built
+# lazily, one whole level at a time, the first time any of their tiles is asked for. the cache is
+# per user, under DEFAULT_CACHE_DIR, and kept to a size by prune_cache. e.g.
+#   ./tile_pyramid.py imgs/*.jpg   # to prebuild all levels
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+
+from PIL import Image
+
+DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'bnn', 'tiles')
+
+# decoded with rawpy, not PIL
+RAW_EXTENSIONS = ('.cr2',)
+
+
+def is_raw(image_path):
+    return image_path.lower().endswith(RAW_EXTENSIONS)
+
+
+def raw_size(raw):
+    # (width, height) of what raw.postprocess() returns; sizes are of the unrotated sensor image,
+    # and postprocess applies the camera's orientation (flip 5 & 6 are 90 degree rotations)
+    if raw.sizes.flip in (5, 6):
+        return raw.sizes.height, raw.sizes.width
+    return raw.sizes.width, raw.sizes.height
+
+
+def decode_image(image_path, size=None):
+    """Decode image_path as an RGB PIL image, resized to size (w, h) if given.
+    For jpegs the decoder is asked to downscale as it goes, so small sizes are cheap.
+    """
+    if is_raw(image_path):
+        # rawpy only imported when needed, it is slow to import
+        import rawpy
+        with rawpy.imread(image_path) as raw:
+            half_size = size is not None and 2 * size[0] <= raw_size(raw)[0]
+            img = Image.fromarray(raw.postprocess(half_size=half_size))
+    else:
+        img = Image.open(image_path)
+        if size is not None:
+            img.draft('RGB', size)  # no-op for anything but jpeg
+    img = img.convert('RGB')
+    if size is not None and img.size != tuple(size):
+        img = img.resize(size, Image.BOX)
+    return img
+
+
+def image_size(image_path):
+    # (width, height) without decoding pixels, where the format allows
+    if is_raw(image_path):
+        import rawpy
+        with rawpy.imread(image_path) as raw:
+            return raw_size(raw)
+    with Image.open(image_path) as img:
+        return img.size
+
+
+class TilePyramid(object):
+    def __init__(self, image_path, cache_dir, tile_size=512):
+        self.image_path = image_path
+        self.tile_size = tile_size
+        # cache keyed on path and stat, so an edited image gets a fresh pyramid
+        stat = os.stat(image_path)
+        key = "%s:%s:%s:%s" % (os.path.abspath(image_path), stat.st_mtime, stat.st_size, tile_size)
+        self.dir = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest())
+        meta_file = os.path.join(self.dir, 'meta.json')
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                self.width, self.height = json.load(f)['size']
+        else:
+            self.width, self.height = image_size(image_path)
+            os.makedirs(self.dir, exist_ok=True)
+            with open(meta_file, 'w') as f:
+                json.dump({'image': os.path.abspath(image_path), 'size': [self.width, self.height]}, f)
+        os.utime(meta_file)  # its mtime is when the pyramid was last used, see prune_cache
+        self.num_levels = 1 + max(0, math.ceil(math.log2(max(self.width, self.height) / tile_size)))
+        # a level may be asked for by more than one thread at once, e.g. a background build() and a
+        # viewer wanting the level it's zoomed to. other levels can be built meanwhile
+        self._build_locks = [threading.Lock() for _ in range(self.num_levels)]
+        self._built = set()  # levels known to be done, saving a stat per check
+
+    def level_size(self, level):
+        scale = 2 ** level
+        return math.ceil(self.width / scale), math.ceil(self.height / scale)
+
+    def num_tiles(self, level):
+        # (num tiles across, num tiles down)
+        w, h = self.level_size(level)
+        return math.ceil(w / self.tile_size), math.ceil(h / self.tile_size)
+
+    def level_for_scale(self, scale):
+        # coarsest level that still has at least one of its pixels per screen pixel when the full
+        # resolution image is drawn at scale screen pixels per image pixel
+        if scale >= 1:
+            return 0
+        return min(self.num_levels - 1, int(math.floor(math.log2(1 / scale))))
+
+    def _level_dir(self, level):
+        return os.path.join(self.dir, str(level))
+
+    def _tile_path(self, level, tx, ty):
+        return os.path.join(self._level_dir(level), "%d_%d.png" % (tx, ty))
+
+    def has_level(self, level):
+        if level not in self._built and os.path.exists(os.path.join(self._level_dir(level), 'done')):
+            self._built.add(level)
+        return level in self._built
+
+    def nearest_built_level(self, level):
+        # level, or the closest coarser one, that's already built; None if none are
+        for nearest in range(level, self.num_levels):
+            if self.has_level(nearest):
+                return nearest
+        return None
+
+    def build_level(self, level):
+        with self._build_locks[level]:
+            if not self.has_level(level):
+                self._build_level(level)
+
+    def _build_level(self, level):
+        img = decode_image(self.image_path, self.level_size(level))
+        os.makedirs(self._level_dir(level), exist_ok=True)
+        num_x, num_y = self.num_tiles(level)
+        for ty in range(num_y):
+            for tx in range(num_x):
+                left, top = tx * self.tile_size, ty * self.tile_size
+                box = (left, top, min(left + self.tile_size, img.width), min(top + self.tile_size, img.height))
+                img.crop(box).save(self._tile_path(level, tx, ty), compress_level=1)
+        # written last, so a level interrupted part way through is rebuilt next time
+        open(os.path.join(self._level_dir(level), 'done'), 'w').close()
+
+    def build(self):
+        # coarsest (cheapest, first shown) levels first
+        for level in reversed(range(self.num_levels)):
+            if not self.has_level(level):
+                self.build_level(level)
+
+    def tile(self, level, tx, ty):
+        """RGB PIL image of tile tx, ty of level. Edge tiles are smaller than tile_size.
+        Builds the level first if needed, which for level 0 of a big image takes seconds; a viewer
+        should draw nearest_built_level and build the level it wants on another thread.
+        """
+        if not self.has_level(level):
+            self.build_level(level)
+        img = Image.open(self._tile_path(level, tx, ty))
+        img.load()
+        return img
+
+
+def _dir_size(path):
+    size = 0
+    for dirpath, _dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                pass  # e.g. a level's tmp files, or being removed by another process
+    return size
+
+
+def prune_cache(cache_dir, max_bytes, keep=()):
+    """Remove the least recently used pyramids from cache_dir until it takes at most max_bytes,
+    other than those whose dirs are in keep. Returns the number removed.
+    """
+    if not os.path.isdir(cache_dir):
+        return 0
+    pyramids = []  # [(last used, dir, bytes), ...]
+    for name in os.listdir(cache_dir):
+        pyramid_dir = os.path.join(cache_dir, name)
+        meta_file = os.path.join(pyramid_dir, 'meta.json')
+        try:
+            pyramids.append((os.path.getmtime(meta_file), pyramid_dir, _dir_size(pyramid_dir)))
+        except OSError:
+            continue  # not a pyramid, or just removed
+    total = sum(size for _last_used, _dir, size in pyramids)
+    num_removed = 0
+    for _last_used, pyramid_dir, size in sorted(pyramids):
+        if total <= max_bytes:
+            break
+        if pyramid_dir in keep:
+            continue
+        shutil.rmtree(pyramid_dir, ignore_errors=True)
+        total -= size
+        num_removed += 1
+    return num_removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--cache-dir', type=str, default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--max-cache-mb', type=int, default=None,
+                        help='if set, afterwards remove least recently used pyramids to keep the cache under this')
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('images', nargs='+')
+    opts = parser.parse_args(argv)
+    for image_path in opts.images:
+        pyramid = TilePyramid(image_path, opts.cache_dir, opts.tile_size)
+        pyramid.build()
+        print("\t".join(map(str, [image_path, pyramid.width, pyramid.height, pyramid.num_levels, pyramid.dir])))
+    if opts.max_cache_mb is not None:
+        print("removed %d pyramids" % prune_cache(opts.cache_dir, opts.max_cache_mb * 2 ** 20))
+
+
+if __name__ == '__main__':
+    main()
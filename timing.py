@@ -0,0 +1,74 @@
+import collections
+import contextlib
+import json
+import time
+
+import numpy as np
+
+
+class StageTimer(object):
+    # accumulates wall clock time per named stage, e.g.
+    #   with timer.stage('decode'):
+    #       ...
+    #   timer.end_step(filename=f)
+    # and optionally writes one json line per step with that step's stage times.
+    def __init__(self, trace_file=None):
+        self.times = collections.defaultdict(list)
+        self.step_times = {}
+        self.trace = open(trace_file, 'w') if trace_file is not None else None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, secs):
+        self.times[name].append(secs)
+        self.step_times[name] = self.step_times.get(name, 0.0) + secs
+
+    def end_step(self, **info):
+        if self.trace is not None:
+            record = dict(info)
+            record['times'] = self.step_times
+            self.trace.write(json.dumps(record) + "\n")
+            self.trace.flush()
+        self.step_times = {}
+
+    def stats(self):
+        # { stage: {n, total, mean, std, p50, p90, p99, max}, ... } in secs
+        stats = {}
+        for name, times in self.times.items():
+            times = np.array(times)
+            p50, p90, p99 = np.percentile(times, [50, 90, 99])
+            stats[name] = {'n': len(times), 'total': float(np.sum(times)),
+                           'mean': float(np.mean(times)), 'std': float(np.std(times)),
+                           'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+                           'max': float(np.max(times))}
+        return stats
+
+    def summary(self, histogram_bins=10):
+        # human readable table of per stage percentiles (in ms) each followed by a histogram
+        lines = []
+        stats = self.stats()
+        overall = sum(s['total'] for s in stats.values())
+        lines.append("%-14s %6s %7s %9s %9s %9s %9s %9s" % (
+            'stage', 'n', '%time', 'mean_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms'))
+        for name, s in stats.items():
+            lines.append("%-14s %6d %6.1f%% %9.2f %9.2f %9.2f %9.2f %9.2f" % (
+                name, s['n'], 100 * s['total'] / overall if overall > 0 else 0,
+                1000 * s['mean'], 1000 * s['p50'], 1000 * s['p90'], 1000 * s['p99'], 1000 * s['max']))
+        for name, times in self.times.items():
+            counts, edges = np.histogram(1000 * np.array(times), bins=histogram_bins)
+            lines.append("%s histogram (ms)" % name)
+            for count, lo, hi in zip(counts, edges[:-1], edges[1:]):
+                bar = '#' * int(round(40 * count / max(counts)))
+                lines.append(("  %9.2f - %9.2f %6d %s" % (lo, hi, count, bar)).rstrip())
+        return "\n".join(lines)
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
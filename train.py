@@ -1,9 +1,9 @@
 #!/usr/bin/env python3
 
 import argparse
-import datetime
 import json
 import os
+import random
 import sys
 import time
 
@@ -11,180 +11,432 @@ import numpy as np
 import tensorflow as tf
 
 import bnn_util
+import checkpointing
 import generate_training_data
+from image_discovery import list_image_files
 import model
 import test
+from timing import StageTimer
 
 np.set_printoptions(precision=2, threshold=10000, suppress=True, linewidth=10000)
 
-parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-parser.add_argument('--train-image-dir', type=str, required=True, help="training images")
-parser.add_argument('--test-image-dir', type=str, required=True, help="test images")
-parser.add_argument('--label-dir', type=str, required=True, help="labels for train/test")
-parser.add_argument('--label-db', type=str, required=True, help="label_db for test P/R/F1 stats")
-parser.add_argument('--patch-width-height', type=int, default=256,
-                    help="what size square patches to sample. None => no patch, i.e. use full res image")
-parser.add_argument('--batch-size', type=int, default=32, help=' ')
-parser.add_argument('--learning-rate', type=float, default=0.001, help=' ')
-parser.add_argument('--pos-weight', type=float, default=1.0, help='positive class weight in loss. 1.0 = balanced')
-parser.add_argument('--run', type=str, required=True, help="run dir for tb & ckpts")
-parser.add_argument('--no-use-skip-connections', action='store_true', help='set to disable skip connections')
-parser.add_argument('--no-use-batch-norm', action='store_true', help='set to disable batch norm')
-parser.add_argument('--base-filter-size', type=int, default=8, help=' ')
-parser.add_argument('--flip-left-right', action='store_true', help='randomly flip training egs left/right')
-parser.add_argument('--random-rotate', action='store_true', help='randomly rotate training images')
-parser.add_argument('--steps', type=int, default=100000,
-                    help='max number of training steps (summaries every --train-steps)')
-parser.add_argument('--train-steps', type=int, default=100, help='number training steps between test and summaries')
-parser.add_argument('--secs', type=int, default=None, help='If set, max number of seconds to run')
-parser.add_argument('--width', type=int, default=768,
-                    help='test image width (assumed training image width if --patch-width-height not set)')
-parser.add_argument('--height', type=int, default=1024,
-                    help='test image height (assumed training height if --patch-width-height not set)')
-parser.add_argument('--connected-components-threshold', type=float, default=0.05)
-opts = parser.parse_args()
-print("opts %s" % opts, file=sys.stderr)
-
-# prep ckpt dir (and save training_opts for restoring model later)
-ckpt_dir = "ckpts/%s" % opts.run
-if not os.path.exists(ckpt_dir):
-    os.makedirs(ckpt_dir)
-with open("%s/opts.json" % ckpt_dir, "w") as f:
-    f.write(json.dumps(vars(opts)))
-
-# from tensorflow.python import debug as tf_debug
-# tf.keras.backend.set_session(tf_debug.LocalCLIDebugWrapperSession(tf.Session()))
-
-# Build readers / model for training
-# training can be either patch based, or full resolution
-train_imgs_xys_bitmaps = generate_training_data.img_xys_iterator(
-    image_dir=opts.train_image_dir,
-    label_dir=opts.label_dir,
-    batch_size=opts.batch_size,
-    patch_width_height=opts.patch_width_height,
-    distort_rgb=True,
-    flip_left_right=opts.flip_left_right,
-    random_rotation=opts.random_rotate,
-    repeat=True
-)
-
-# TODO: could we do all these calcs in test.pr_stats (rather than iterating twice) ??
-# test images are always full res
-test_imgs_xys_bitmaps = generate_training_data.img_xys_iterator(
-    image_dir=opts.test_image_dir,
-    label_dir=opts.label_dir,
-    batch_size=opts.batch_size,
-    patch_width_height=None,
-    distort_rgb=False,
-    flip_left_right=False,
-    random_rotation=False,
-    repeat=False
-)
-
-num_test_files = len(os.listdir(opts.test_image_dir))
-num_test_steps = num_test_files // opts.batch_size
-print("num_test_files=", num_test_files, "batch_size=", opts.batch_size, "=> num_test_steps=", num_test_steps)
-
-# training model.
-train_model = model.construct_model(
-    width=opts.patch_width_height or opts.width,
-    height=opts.patch_width_height or opts.height,
-    use_skip_connections=not opts.no_use_skip_connections,
-    base_filter_size=opts.base_filter_size,
-    use_batch_norm=not opts.no_use_batch_norm
-)
-model.compile_model(
-    train_model,
-    learning_rate=opts.learning_rate,
-    pos_weight=opts.pos_weight
-)
-print("TRAIN MODEL")
-print(train_model.summary())
-
-# test model.
-test_model = model.construct_model(
-    width=opts.width,
-    height=opts.height,
-    use_skip_connections=not opts.no_use_skip_connections,
-    base_filter_size=opts.base_filter_size,
-    use_batch_norm=not opts.no_use_batch_norm
-)
-model.compile_model(
-    test_model,
-    learning_rate=opts.learning_rate,
-    pos_weight=opts.pos_weight
-)
-print("TEST MODEL")
-print(test_model.summary())
-
-# Setup summary writers. (Will create explicit summaries to write)
-# TODO: include keras default callback
-train_summaries_writer = tf.summary.create_file_writer("tb/%s/training" % opts.run)
-test_summaries_writer = tf.summary.create_file_writer("tb/%s/test" % opts.run)
-
-start_time = time.time()
-done = False
-step = 0
-
-while not done:
-    # train a bit.
-    history = train_model.fit(
-        train_imgs_xys_bitmaps,
-        epochs=1,
-        verbose=1,
-        steps_per_epoch=opts.train_steps
+
+def main(argv=None, context=None):
+    # context, if set, is a bnn.Context; any model it has cached for this run is dropped once
+    # training has written new weights
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--train-image-dir', type=str, required=True, help="training images")
+    parser.add_argument('--test-image-dir', type=str, required=True, help="test images")
+    parser.add_argument('--label-dir', type=str, required=True, help="labels for train/test")
+    parser.add_argument('--label-db', type=str, required=True, help="label_db for test P/R/F1 stats")
+    parser.add_argument('--patch-width-height', type=int, default=256,
+                        help="what size square patches to sample. None => no patch, i.e. use full res image")
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='per replica batch size; with --multi-worker the global batch is this times the'
+                             ' number of replicas')
+    parser.add_argument('--accumulate-steps', type=int, default=1,
+                        help='micro batches of --batch-size to accumulate gradients over per optimizer step, for'
+                             ' an effective batch this many times bigger in the memory of one micro batch')
+    parser.add_argument('--learning-rate', type=float, default=0.001, help=' ')
+    parser.add_argument('--pos-weight', type=float, default=1.0, help='positive class weight in loss. 1.0 = balanced')
+    parser.add_argument('--run', type=str, required=True, help="run dir for tb & ckpts")
+    parser.add_argument('--no-use-skip-connections', action='store_true', help='set to disable skip connections')
+    parser.add_argument('--no-use-batch-norm', action='store_true', help='set to disable batch norm')
+    parser.add_argument('--base-filter-size', type=int, default=8, help=' ')
+    parser.add_argument('--separable-convs', action='store_true',
+                        help='use depthwise separable convs in all but the first block')
+    parser.add_argument('--encoder-depth', type=int, default=4,
+                        help='number of downsampling blocks; image sizes must be multiples of 2**this')
+    parser.add_argument('--output-stride', type=int, default=2, choices=[2, 4],
+                        help='model outputs at 1/this of input resolution. --label-dir must have been'
+                             ' materialised with --label-rescale 1/this')
+    parser.add_argument('--flip-left-right', action='store_true', help='randomly flip training egs left/right')
+    parser.add_argument('--random-rotate', action='store_true', help='randomly rotate training images')
+    parser.add_argument('--steps', type=int, default=100000,
+                        help='max number of training steps (summaries & checkpoints every --train-steps)')
+    parser.add_argument('--train-steps', type=int, default=100, help='number training steps between test and summaries')
+    parser.add_argument('--secs', type=int, default=None, help='If set, max number of seconds to run')
+    parser.add_argument('--width', type=int, default=768,
+                        help='test image width (assumed training image width if --patch-width-height not set)')
+    parser.add_argument('--height', type=int, default=1024,
+                        help='test image height (assumed training height if --patch-width-height not set)')
+    parser.add_argument('--connected-components-threshold', type=float, default=0.05)
+    parser.add_argument('--keep-checkpoints', type=int, default=5, help='number of most recent checkpoints to keep')
+    parser.add_argument('--keep-best-checkpoints', type=int, default=0,
+                        help='number of best checkpoints, by --best-metric, to keep as well as the most recent')
+    parser.add_argument('--best-metric', type=str, default='train_loss', help='metric to rank checkpoints by')
+    parser.add_argument('--best-metric-mode', type=str, default='min', choices=['min', 'max'],
+                        help='whether lower or higher --best-metric is better')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed for training input order & augmentation. if not set a random one, or with'
+                             ' --resume the one of the run being resumed')
+    parser.add_argument('--resume', action='store_true',
+                        help='carry on from the latest checkpoint of --run; weights, optimizer state, step and'
+                             ' position in the training input')
+    parser.add_argument('--multi-worker', action='store_true',
+                        help='train data parallel across the workers in TF_CONFIG (see run_workers.py), each reading'
+                             ' its own shard of the training images. ckpts/ must be shared between them')
+    parser.add_argument('--teacher-run', type=str, default=None,
+                        help='if set, distill this (bigger) run into the one being trained; the loss is mixed with'
+                             ' one against the teacher\'s predictions, see --distill-alpha')
+    parser.add_argument('--teacher-heatmap-dir', type=str, default=None,
+                        help='teacher_heatmaps.py predictions of --teacher-run for the training images. if not set'
+                             ' the teacher is run on each batch')
+    parser.add_argument('--distill-alpha', type=float, default=0.5,
+                        help='with --teacher-run, weight of the loss against the teacher (vs against the labels)')
+    parser.add_argument('--distill-temperature', type=float, default=2.0,
+                        help='with --teacher-run, temperature to soften teacher & student predictions by')
+    parser.add_argument('--timing-trace', type=str, default=None,
+                        help='if set, write per step stage timings to this file as json lines')
+    parser.add_argument('--tf-profile-dir', type=str, default=None,
+                        help='if set, capture a tensorflow profiler trace for --tf-profile-steps into this dir')
+    parser.add_argument('--tf-profile-steps', type=str, default='10:20',
+                        help='start:end steps, counted from the start of this run, to capture in profiler trace')
+    opts = parser.parse_args(argv)
+    if opts.teacher_heatmap_dir is not None and opts.teacher_run is None:
+        raise Exception("--teacher-heatmap-dir needs the --teacher-run it was made with")
+
+    # the strategy has to be made before any other tensorflow ops
+    if opts.multi_worker:
+        strategy = tf.distribute.MultiWorkerMirroredStrategy()
+        resolver = strategy.cluster_resolver
+        num_workers = resolver.cluster_spec().num_tasks('worker') + resolver.cluster_spec().num_tasks('chief')
+        # the chief, or worker 0 if there isn't one, writes checkpoints and summaries
+        is_chief = resolver.task_type == 'chief' or \
+            (resolver.task_type == 'worker' and resolver.task_id == 0 and 'chief' not in resolver.cluster_spec().jobs)
+    else:
+        strategy = tf.distribute.get_strategy()
+        num_workers = 1
+        is_chief = True
+    global_batch_size = opts.batch_size * strategy.num_replicas_in_sync
+    examples_per_step = global_batch_size * opts.accumulate_steps
+
+    # prep ckpt dir (and save training_opts for restoring model later)
+    ckpt_dir = "ckpts/%s" % opts.run
+    if not os.path.exists(ckpt_dir):
+        os.makedirs(ckpt_dir)
+    resume_ckpt = None
+    if opts.resume:
+        resume_ckpt = checkpointing.latest_checkpoint(ckpt_dir)
+        if resume_ckpt is None:
+            raise Exception("--resume set but there are no checkpoints in %s" % ckpt_dir)
+        if opts.seed is None:
+            with open("%s/opts.json" % ckpt_dir) as f:
+                opts.seed = json.load(f).get('seed')
+            if opts.seed is None:
+                raise Exception("run %s has no recorded seed, pass --seed to --resume it" % opts.run)
+    if opts.seed is None:
+        if opts.multi_worker:
+            raise Exception("--multi-worker needs an explicit --seed, so all workers agree on it")
+        opts.seed = random.randrange(2 ** 31)
+    tf.random.set_seed(opts.seed)  # for weight init
+    print("opts %s" % opts, file=sys.stderr)
+    if is_chief:
+        with open("%s/opts.json" % ckpt_dir, "w") as f:
+            f.write(json.dumps(vars(opts)))
+    print("num_workers=", num_workers, "num_replicas=", strategy.num_replicas_in_sync,
+          "global_batch_size=", global_batch_size, "examples_per_step=", examples_per_step)
+
+    # the training input is a function of the seed and the step, so resuming carries on from the
+    # same point of the same stream
+    start_step = 0
+    if resume_ckpt is not None:
+        start_step, model_weights, optimizer_weights = checkpointing.load_checkpoint(resume_ckpt)
+        print("resuming from %s at step %d" % (resume_ckpt, start_step))
+
+    # from tensorflow.python import debug as tf_debug
+    # tf.keras.backend.set_session(tf_debug.LocalCLIDebugWrapperSession(tf.Session()))
+
+    # Build readers / model for training
+    # training can be either patch based, or full resolution
+    # each worker reads its own shard of the training images
+    def train_dataset(input_context):
+        return generate_training_data.img_xys_iterator(
+            image_dir=opts.train_image_dir,
+            label_dir=opts.label_dir,
+            batch_size=input_context.get_per_replica_batch_size(global_batch_size),
+            patch_width_height=opts.patch_width_height,
+            distort_rgb=True,
+            flip_left_right=opts.flip_left_right,
+            random_rotation=opts.random_rotate,
+            repeat=True,
+            label_rescale=1 / opts.output_stride,
+            seed=opts.seed,
+            skip_batches=start_step * opts.accumulate_steps,
+            num_shards=input_context.num_input_pipelines,
+            shard_index=input_context.input_pipeline_id,
+            teacher_heatmap_dir=opts.teacher_heatmap_dir
+        )
+    if opts.multi_worker:
+        train_imgs_xys_bitmaps = strategy.distribute_datasets_from_function(train_dataset)
+    else:
+        train_imgs_xys_bitmaps = train_dataset(tf.distribute.InputContext())
+
+    # TODO: could we do all these calcs in test.pr_stats (rather than iterating twice) ??
+    # test images are always full res
+    test_imgs_xys_bitmaps = generate_training_data.img_xys_iterator(
+        image_dir=opts.test_image_dir,
+        label_dir=opts.label_dir,
+        batch_size=opts.batch_size,
+        patch_width_height=None,
+        distort_rgb=False,
+        flip_left_right=False,
+        random_rotation=False,
+        repeat=False,
+        label_rescale=1 / opts.output_stride
+    )
+
+    num_test_files = len(list_image_files(opts.test_image_dir))
+    num_test_steps = num_test_files // opts.batch_size
+    print("num_test_files=", num_test_files, "batch_size=", opts.batch_size, "=> num_test_steps=", num_test_steps)
+
+    # training model; variables made under the strategy's scope are mirrored across workers
+    with strategy.scope():
+        train_model = model.construct_model(
+            width=opts.patch_width_height or opts.width,
+            height=opts.patch_width_height or opts.height,
+            use_skip_connections=not opts.no_use_skip_connections,
+            base_filter_size=opts.base_filter_size,
+            use_batch_norm=not opts.no_use_batch_norm,
+            separable_convs=opts.separable_convs,
+            encoder_depth=opts.encoder_depth,
+            output_stride=opts.output_stride
+        )
+        model.compile_model(
+            train_model,
+            learning_rate=opts.learning_rate,
+            pos_weight=opts.pos_weight,
+            distill_alpha=opts.distill_alpha if opts.teacher_run is not None else None,
+            distill_temperature=opts.distill_temperature
+        )
+        if opts.accumulate_steps > 1:
+            # each micro batch is normalised by its own statistics, but the moving averages used at
+            # test time are updated once per micro batch. decay them correspondingly faster, so they
+            # average over the same number of examples as with one update per effective batch
+            for layer in train_model.layers:
+                if isinstance(layer, tf.keras.layers.BatchNormalization):
+                    layer.momentum = layer.momentum ** (1 / opts.accumulate_steps)
+        if resume_ckpt is not None:
+            checkpointing.set_model_and_optimizer_weights(train_model, model_weights, optimizer_weights)
+        # without cached heatmaps, the teacher predicts each batch alongside the training step
+        teacher = None
+        if opts.teacher_run is not None and opts.teacher_heatmap_dir is None:
+            _teacher_opts, teacher = model.restore_model(opts.teacher_run)
+    print("TRAIN MODEL")
+    print(train_model.summary())
+
+    # test model.
+    test_model = model.construct_model(
+        width=opts.width,
+        height=opts.height,
+        use_skip_connections=not opts.no_use_skip_connections,
+        base_filter_size=opts.base_filter_size,
+        use_batch_norm=not opts.no_use_batch_norm,
+        separable_convs=opts.separable_convs,
+        encoder_depth=opts.encoder_depth,
+        output_stride=opts.output_stride
+    )
+    model.compile_model(
+        test_model,
+        learning_rate=opts.learning_rate,
+        pos_weight=opts.pos_weight
     )
-    train_loss = history.history['loss'][0]
-
-    # do eval using test model
-    # TODO: switch to sharing layers between these two over this explicit get/set_weights
-    # test_model.set_weights(train_model.get_weights())
-    # test_loss = test_model.evaluate(
-    #     test_imgs_xys_bitmaps,
-    #     verbose=1,
-    #     steps=num_test_steps
-    # )
-
-    # train / test summaries
-    # includes loss summaries as well as a hand rolled debug image
-
-    # ...train
-    # train_summaries_writer.add_summary(bnn_util.explicit_summaries({"xent": train_loss}), step)
-    #  debug_img_summary = u.pil_image_to_tf_summary(u.debug_img(i[0], bm[0], o[0]))
-    #  train_summaries_writer.add_summary(debug_img_summary, step)
-    train_summaries_writer.flush()
-
-    # save model
-    dts = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    save_filename = "%s/%s" % (ckpt_dir, dts)
-    train_model.save_weights(save_filename)
-
-    # ... test
-    # stats = test.pr_stats(opts.run, opts.test_image_dir, opts.label_db, opts.connected_components_threshold)
-    # tag_values = {k: stats[k] for k in ['precision', 'recall', 'f1']}
-    # test_summaries_writer.add_summary(bnn_util.explicit_summaries({"xent": test_loss}), step)
-    # test_summaries_writer.add_summary(bnn_util.explicit_summaries(tag_values), step)
-    # for idx, img in enumerate(stats['debug_imgs']):
-    #     debug_img_summary = bnn_util.pil_image_to_tf_summary(img, tag="debug_img_%d" % idx)
-    #     test_summaries_writer.add_summary(debug_img_summary, step)
-    test_summaries_writer.flush()
-
-    # report one liner
-    log = list()
-    log.append("step %d/%d" % (step, opts.steps))
-    log.append("time %d" % int(time.time() - start_time))
-    log.append("train_loss %f" % train_loss)
-    # log.append("test_loss %s" % test_loss)
-    # log.append("test stats { p:%0.2f, r:%0.2f, f1:%0.2f }" % tuple([stats[k] for k in ['precision', 'recall', 'f1']]))
-    print("\t".join(log))
-
-    # check if done by steps or time
-    step += 1  # TODO: fetch global_step from keras model (?)
-    if step >= opts.steps:
-        done = True
-    if opts.secs is not None:
-        run_time = time.time() - start_time
-        remaining_time = opts.secs - run_time
-        print("run_time %s remaining_time %s" % (bnn_util.hms(run_time), bnn_util.hms(remaining_time)))
-        if remaining_time < 0:
-            done = True
+    print("TEST MODEL")
+    print(test_model.summary())
+
+    # Setup summary writers. (Will create explicit summaries to write)
+    # TODO: include keras default callback
+    # checkpoints are written on a background thread. both only by the chief
+    if is_chief:
+        train_summaries_writer = tf.summary.create_file_writer("tb/%s/training" % opts.run)
+        test_summaries_writer = tf.summary.create_file_writer("tb/%s/test" % opts.run)
+        checkpoints = checkpointing.CheckpointWriter(ckpt_dir,
+                                                     keep_last=opts.keep_checkpoints,
+                                                     keep_best=opts.keep_best_checkpoints,
+                                                     best_metric=opts.best_metric,
+                                                     best_mode=opts.best_metric_mode)
+    else:
+        train_summaries_writer = test_summaries_writer = tf.summary.create_noop_writer()
+        checkpoints = None
+
+    def any_worker(flag):
+        # True if flag is True on any worker, so they all stop together
+        if num_workers == 1:
+            return flag
+        per_replica = strategy.run(lambda: tf.constant(1 if flag else 0))
+        return int(strategy.reduce(tf.distribute.ReduceOp.SUM, per_replica, axis=None)) > 0
+
+    # one training step, on every replica, returning the mean over replicas of the running mean
+    # loss since the metrics were last reset
+    def with_teacher_probs(batch):
+        # when distilling without cached heatmaps, add the teacher's probabilities as a second label
+        # channel, as generate_training_data.py does with them
+        if teacher is None:
+            return batch
+        x, y = batch
+        teacher_probs = tf.sigmoid(teacher(x, training=False))
+        teacher_probs = tf.image.resize(teacher_probs, tf.shape(y)[1:3])  # teacher's output stride may differ
+        return x, tf.concat([y, teacher_probs], axis=-1)
+
+    @tf.function
+    def keras_train_step(batch):
+        per_replica_logs = strategy.run(lambda batch: train_model.train_step(with_teacher_probs(batch)),
+                                        args=(batch,))
+        return strategy.reduce(tf.distribute.ReduceOp.MEAN, per_replica_logs['loss'], axis=None)
+
+    # with --accumulate-steps the mean gradient over the micro batches is summed up one micro batch
+    # per call, so only one micro batch's activations are ever held, then applied as one update
+    variables = train_model.trainable_variables
+
+    @tf.function
+    def zero_gradients():
+        return strategy.run(lambda: [tf.zeros_like(v) for v in variables])
+
+    def replica_accumulate(batch, gradients):
+        x, y = with_teacher_probs(batch)
+        with tf.GradientTape() as tape:
+            y_pred = train_model(x, training=True)
+            # as in the model's own train_step; also updates its running mean loss metric
+            loss = train_model.compiled_loss(y, y_pred, regularization_losses=train_model.losses)
+        micro_gradients = tape.gradient(loss, variables)
+        return [g + mg / opts.accumulate_steps for g, mg in zip(gradients, micro_gradients)]
+
+    @tf.function
+    def accumulate_gradients(batch, gradients):
+        return strategy.run(replica_accumulate, args=(batch, gradients))
+
+    @tf.function
+    def apply_gradients(gradients):
+        strategy.run(lambda gradients: train_model.optimizer.apply_gradients(zip(gradients, variables)),
+                     args=(gradients,))
+
+    def train_step(batches):
+        if len(batches) == 1:
+            return keras_train_step(batches[0])
+        gradients = zero_gradients()
+        for batch in batches:
+            gradients = accumulate_gradients(batch, gradients)
+        apply_gradients(gradients)
+        # the loss metric's result is already aggregated over replicas
+        return next(m for m in train_model.metrics if m.name == 'loss').result()
+
+    # per step stage times; input_wait (blocked on the input pipeline) + optimizer_step (forward,
+    # backward & update) make up the step time. bookkeeping is the summaries & checkpoints between
+    timer = StageTimer(trace_file=opts.timing_trace if is_chief else None)
+    tf_profile_start, tf_profile_end = map(int, opts.tf_profile_steps.split(':'))
+
+    start_time = time.time()
+    block_start_time = time.time()
+
+    def end_of_block(step, train_loss):
+        # called after every --train-steps steps; returns True if training is done
+
+        # do eval using test model
+        # TODO: switch to sharing layers between these two over this explicit get/set_weights
+        # test_model.set_weights(train_model.get_weights())
+        # test_loss = test_model.evaluate(
+        #     test_imgs_xys_bitmaps,
+        #     verbose=1,
+        #     steps=num_test_steps
+        # )
+
+        # train / test summaries
+        # includes loss summaries as well as a hand rolled debug image
+
+        # ...train
+        with train_summaries_writer.as_default():
+            tf.summary.scalar('xent', train_loss, step=step)
+        #  debug_img_summary = u.pil_image_to_tf_summary(u.debug_img(i[0], bm[0], o[0]))
+        #  train_summaries_writer.add_summary(debug_img_summary, step)
+        train_summaries_writer.flush()
+
+        # save model
+        if checkpoints is not None:
+            checkpoints.save(step, train_model, metrics={'train_loss': train_loss})
+
+        # ... test
+        # (test set P/R/F1 & debug images are written to tb/<run>/test by eval_sidecar.py, in
+        # its own process, rather than holding up training here)
+        # stats = test.pr_stats(opts.run, opts.test_image_dir, opts.label_db, opts.connected_components_threshold)
+        # tag_values = {k: stats[k] for k in ['precision', 'recall', 'f1']}
+        # test_summaries_writer.add_summary(bnn_util.explicit_summaries({"xent": test_loss}), step)
+        # test_summaries_writer.add_summary(bnn_util.explicit_summaries(tag_values), step)
+        # for idx, img in enumerate(stats['debug_imgs']):
+        #     debug_img_summary = bnn_util.pil_image_to_tf_summary(img, tag="debug_img_%d" % idx)
+        #     test_summaries_writer.add_summary(debug_img_summary, step)
+        test_summaries_writer.flush()
+
+        # report one liner
+        log = list()
+        log.append("step %d/%d" % (step, opts.steps))
+        log.append("time %d" % int(time.time() - start_time))
+        log.append("train_loss %f" % train_loss)
+        nonlocal block_start_time
+        log.append("examples/sec %.1f" % (opts.train_steps * examples_per_step / (time.time() - block_start_time)))
+        block_start_time = time.time()
+        # log.append("test_loss %s" % test_loss)
+        # log.append("test stats { p:%0.2f, r:%0.2f, f1:%0.2f }" % tuple([stats[k] for k in ['precision', 'recall', 'f1']]))
+        print("\t".join(log))
+
+        # check if done by steps or time
+        done = step >= opts.steps
+        if opts.secs is not None:
+            run_time = time.time() - start_time
+            remaining_time = opts.secs - run_time
+            print("run_time %s remaining_time %s" % (bnn_util.hms(run_time), bnn_util.hms(remaining_time)))
+            if remaining_time < 0:
+                done = True
+        return any_worker(done)
+
+    # the input stream carries on from block to block, rather than restarting
+    iterator = iter(train_imgs_xys_bitmaps)
+    # global step is the optimizer's, so it's saved (and restored) with the checkpoint
+    step = int(train_model.optimizer.iterations.numpy())
+    done = step >= opts.steps
+    profiling = False
+    try:
+        while not done:
+            if opts.tf_profile_dir is not None and step - start_step == tf_profile_start:
+                tf.profiler.experimental.start(opts.tf_profile_dir)
+                profiling = True
+
+            with timer.stage('input_wait'):
+                batches = [next(iterator) for _ in range(opts.accumulate_steps)]
+            with timer.stage('optimizer_step'):
+                train_loss = float(train_step(batches))  # float() waits for the step to finish
+            step += 1
+
+            if profiling and step - start_step == tf_profile_end:
+                tf.profiler.experimental.stop()
+                profiling = False
+
+            with timer.stage('bookkeeping'):
+                input_wait = timer.step_times['input_wait']
+                step_time = input_wait + timer.step_times['optimizer_step']
+                with train_summaries_writer.as_default():
+                    tf.summary.scalar('step_time_ms', 1000 * step_time, step=step)
+                    tf.summary.scalar('optimizer_step_ms', 1000 * timer.step_times['optimizer_step'], step=step)
+                    tf.summary.scalar('input_wait_fraction', input_wait / step_time, step=step)
+                    tf.summary.scalar('examples_per_sec', examples_per_step / step_time, step=step)
+                if step % opts.train_steps == 0 or step >= opts.steps:
+                    done = end_of_block(step, train_loss)
+                    train_model.reset_metrics()  # so the next block's loss is its own mean
+            timer.end_step(step=step, train_loss=train_loss)
+    finally:
+        # also reached on ctrl-c
+        if profiling:
+            tf.profiler.experimental.stop()
+        timer.close()
+        if len(timer.times):
+            print(timer.summary(), file=sys.stderr)
+
+    # wait for the last checkpoint to be written, and mark the run finished for eval_sidecar.py
+    if checkpoints is not None:
+        checkpoints.close(finished=True)
+
+    if context is not None:
+        context.forget_model(opts.run)
+
+
+if __name__ == '__main__':
+    main()